@@ -1,11 +1,21 @@
 import argparse
+from array import array
+import base64
 import datetime
+import errno
 import json
+import mmap
 import os
 import platform
+import stat
+import struct
+from concurrent.futures import ThreadPoolExecutor
 from shutil import which
 import signal
+import statistics
 import subprocess
+import sys
+import threading
 import time
 from pathlib import Path
 
@@ -13,7 +23,6 @@ from hypy_utils import color
 from hypy_utils.logging_utils import setup_logger
 
 log = setup_logger()
-speeds = []
 
 
 def signal_handler(sig, frame):
@@ -27,136 +36,664 @@ def signal_handler(sig, frame):
 pending_stop = False
 signal.signal(signal.SIGINT, signal_handler)
 
+# All disks being scanned, used for the aggregated progress summary
+scans: list["DiskScan"] = []
+scans_lock = threading.Lock()
 
-def to_gb(block: int):
-    return block * BLOCK_SIZE / (1024 * 1024 * 1024)
 
+class LogStore:
+    """
+    Append-only JSONL scan log. The first line is a header with the block size, every following line
+    is one scanned slice. Each record is written with a single append, so a crash can at most leave
+    one incomplete trailing line, which is ignored when reading and cut off when reopening.
+    """
+    def __init__(self, path: Path, fsync: str = "interval", fsync_interval: float = 10):
+        """
+        :param path: Log file path
+        :param fsync: "always" to fsync after each record, "interval" to fsync at most every
+            fsync_interval seconds, or "never" to leave it to the OS
+        """
+        self.path = path
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self._last_sync = time.time()
+        self._f = None
 
-def disk_info() -> tuple[int, int]:
-    # Get the disk size in blocks
-    disk_size = int(subprocess.run(f"blockdev --getsize64 {DISK}", capture_output=True, text=True, shell=True).stdout) // BLOCK_SIZE
-    log.info(f"Disk size: {to_gb(disk_size):,.0f} GB, {disk_size:#x} blocks")
+    def exists(self) -> bool:
+        return self.path.exists() and self.path.stat().st_size > 0
 
-    # Get the size of a logical sector (LDA)
-    lss = int(subprocess.run(f"blockdev --getss {DISK}", capture_output=True, text=True, shell=True).stdout)
-    pss = int(subprocess.run(f"blockdev --getpbsz {DISK}", capture_output=True, text=True, shell=True).stdout)
-    log.info(f"Logical sector size: {lss} bytes, physical sector size: {pss} bytes")
+    def create(self, block_size: int):
+        with self.path.open("wb") as f:
+            f.write(json.dumps({"block_size": block_size}).encode() + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
 
-    return disk_size, lss
+    def header(self) -> dict:
+        with self.path.open("rb") as f:
+            return json.loads(f.readline())
 
+    def tail(self) -> dict | None:
+        """
+        Read only the last complete record, without reading the whole file
 
-def run_badblocks(start_block: int, end_block: int):
-    # Print block address in hex
-    log.debug(f"Scanning from {start_block:#x} ({to_gb(start_block):,.0f} GB) to {end_block:#x} ({to_gb(end_block):,.0f} GB)")
+        :return: Last record, or None if there are no records
+        """
+        with self.path.open("rb") as f:
+            end = f.seek(0, os.SEEK_END)
+            size = 4096
+            while True:
+                f.seek(max(0, end - size))
+                lines = f.read(min(size, end)).split(b"\n")
+                # The first line might be cut off unless we reached the start of the file
+                candidates = lines if size >= end else lines[1:]
+                for line in reversed(candidates):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    return record if "start_block" in record else None
+                if size >= end:
+                    return None
+                size *= 4
 
-    command = f"badblocks -b 4096 -v {DISK} {end_block} {start_block}"
-    duration = time.time()
-    result = subprocess.run(command, capture_output=True, text=True, shell=True, start_new_session=True)
-    duration = time.time() - duration
+    def records(self) -> list[dict]:
+        """
+        Read all complete records
+        """
+        out = []
+        with self.path.open("rb") as f:
+            f.readline()
+            for line in f:
+                try:
+                    out.append(json.loads(line))
+                except ValueError:
+                    # Incomplete trailing line from a crash
+                    pass
+        return out
 
-    # stdout should be a list of bad blocks, parse it
-    bad_blocks = [int(r) for r in result.stdout.strip().split("\n") if r]
+    def append(self, record: dict):
+        if self._f is None:
+            self._repair()
+            self._f = self.path.open("ab", buffering=0)
+        self._f.write(json.dumps(record).encode() + b"\n")
 
-    # Write the log as json
-    logf = json.loads(LOG_FILE.read_text())
-    logf["logs"].append({
-        "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "duration": duration,
-        "start_block": start_block,
-        "end_block": end_block,
-        "bad_blocks": bad_blocks,
-        "stderr": result.stderr,
-    })
-    LOG_FILE.write_text(json.dumps(logf, indent=2))
+        now = time.time()
+        if self.fsync == "always" or (self.fsync == "interval" and now - self._last_sync >= self.fsync_interval):
+            os.fsync(self._f.fileno())
+            self._last_sync = now
 
-    # Print logs
-    if bad_blocks:
-        log.error(f"> Bad blocks found: ")
-        for block in bad_blocks:
-            # Pint in hex
-            log.error(f"> {block:#x} = LDA {block * BLOCK_SIZE // lss:#x} = {block * BLOCK_SIZE / (1024 * 1024 * 1024):,.0f} GB")
-    else:
-        log.debug(color(f"> Clean!"))
+    def _repair(self):
+        """
+        Cut off an incomplete trailing line so that new records start on a fresh line
+        """
+        with self.path.open("r+b") as f:
+            end = pos = f.seek(0, os.SEEK_END)
+            # Scan backwards block by block, the broken record can be longer than one block
+            while pos > 0:
+                start = max(0, pos - 65536)
+                f.seek(start)
+                chunk = f.read(pos - start)
+                i = chunk.rfind(b"\n")
+                if i >= 0:
+                    if start + i + 1 != end:
+                        f.truncate(start + i + 1)
+                    return
+                pos = start
+            f.truncate(0)
 
-    # Print summary (speed, progress, eta, etc.)
-    # The stored speed is in blocks per second
-    speed = (end_block - start_block) / duration
-    speeds.append(speed)
-    avg_spd = sum(speeds) / len(speeds)
-    progress = end_block / disk_size
+    def close(self):
+        if self._f is not None:
+            os.fsync(self._f.fileno())
+            self._f.close()
+            self._f = None
 
-    # Calculate ETA
-    eta = (disk_size - end_block) / avg_spd
-    eta = str(datetime.timedelta(seconds=eta))[:-7]
+    def compact(self):
+        """
+        Atomically rewrite the log: keep only the latest record for each slice (e.g. after a
+        rescan), sort by block, and drop the stderr of clean slices
+        """
+        header, latest = self.header(), {}
+        for r in self.records():
+            latest[r["start_block"]] = r
+        tmp = self.path.with_suffix(".tmp")
+        with tmp.open("wb") as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            for _, r in sorted(latest.items()):
+                if not r["bad_blocks"]:
+                    r.pop("stderr", None)
+                f.write(json.dumps(r).encode() + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
 
-    # Convert speed to MB/s
-    speed *= BLOCK_SIZE / (1024 * 1024)
-    avg_spd *= BLOCK_SIZE / (1024 * 1024)
 
-    log.info(f"> {progress * 100:.2f}% | Cur {speed:.1f} MB/s | Remain {eta} | "
-             f"Avg {avg_spd:.1f} MB/s")
+# ioctl to get the logical sector size of a block device
+BLKSSZGET = 0x1268
+
+
+def logical_sector_size(fd: int, disk: str) -> int:
+    """
+    Get the logical sector size, which O_DIRECT reads must be aligned to
+    """
+    if not stat.S_ISBLK(os.fstat(fd).st_mode):
+        # Image files, aligning to 512 bytes is enough for most file systems
+        return 512
+    try:
+        import fcntl
+        return struct.unpack("i", fcntl.ioctl(fd, BLKSSZGET, b"\0" * 4))[0]
+    except (ImportError, OSError):
+        name = Path(os.path.realpath(disk)).name
+        return int(Path(f"/sys/class/block/{name}/queue/logical_block_size").read_text())
+
+
+class NativeVerifier:
+    """
+    Built-in read-only verification engine, replacing the external badblocks binary for read-only
+    scans. The device is opened once with O_DIRECT (bypassing the page cache) and read sequentially
+    with large aligned reads. Failed reads are bisected down to single blocks to pinpoint bad sectors.
+    """
+    def __init__(self, disk: str, block_size: int, read_size: int = 8 * 1024 * 1024,
+                 sector_size: int | None = None):
+        """
+        :param disk: Device or image file to read
+        :param block_size: Block size, must be a multiple of the logical sector size
+        :param read_size: Bytes to read at a time
+        :param sector_size: Logical sector size, detected from the device if None
+        """
+        self.block_size = block_size
+        self.chunk_blocks = max(1, read_size // block_size)
+        try:
+            self.fd = os.open(disk, os.O_RDONLY | getattr(os, "O_DIRECT", 0))
+        except OSError as e:
+            # Some file systems (e.g. tmpfs for test images) don't support O_DIRECT
+            if e.errno != errno.EINVAL:
+                raise
+            self.fd = os.open(disk, os.O_RDONLY)
+
+        # Misaligned O_DIRECT reads fail with EINVAL, which would otherwise look like bad blocks
+        self.sector_size = sector_size or logical_sector_size(self.fd, disk)
+        if block_size % self.sector_size:
+            os.close(self.fd)
+            raise ValueError(f"Block size {block_size} of {disk} is not a multiple of its logical sector size "
+                             f"{self.sector_size}, use -b {self.sector_size}")
+        # Anonymous mmaps are page aligned, as O_DIRECT requires
+        self.buf = mmap.mmap(-1, self.chunk_blocks * block_size)
+        self.errors: list[str] = []
+
+    def read_ok(self, start_block: int, blocks: int) -> bool:
+        view = memoryview(self.buf)[:blocks * self.block_size]
+        try:
+            n = os.preadv(self.fd, [view], start_block * self.block_size)
+            if n != len(view):
+                self.errors.append(f"{start_block:#x}: short read ({n} of {len(view)} bytes)")
+            return n == len(view)
+        except OSError as e:
+            # EINVAL is a misconfiguration (e.g. misaligned reads), not a bad block
+            if e.errno == errno.EINVAL:
+                raise
+            self.errors.append(f"{start_block:#x}: {e.strerror}")
+            return False
+        finally:
+            view.release()
+
+    def bisect(self, start_block: int, blocks: int) -> list[int]:
+        """
+        Find the bad blocks in a range that failed to read
+        """
+        if blocks == 1:
+            return [start_block]
+        half = blocks // 2
+        bad = []
+        for s, n in ((start_block, half), (start_block + half, blocks - half)):
+            if not self.read_ok(s, n):
+                bad += self.bisect(s, n)
+        return bad
+
+    def verify(self, start_block: int, end_block: int) -> tuple[list[int], str]:
+        """
+        :return: Bad blocks, and the read errors encountered (in place of badblocks' stderr)
+        """
+        self.errors = []
+        bad = []
+        for s in range(start_block, end_block, self.chunk_blocks):
+            n = min(self.chunk_blocks, end_block - s)
+            if not self.read_ok(s, n):
+                bad += self.bisect(s, n)
+        return bad, "\n".join(self.errors)
+
+    def close(self):
+        self.buf.close()
+        os.close(self.fd)
+
+
+class Telemetry:
+    """
+    Per-slice throughput samples, stored in arrays to stay compact over tens of thousands of slices.
+
+    HDD throughput drops toward the inner tracks (higher LBAs), so the ETA follows a linear
+    throughput-vs-LBA fit instead of the global average. Slices far below the median of their
+    neighbours are reported as slow regions, which often precede failures.
+    """
+    def __init__(self, window: int = 16, slow_ratio: float = 0.5):
+        self.window = window
+        self.slow_ratio = slow_ratio
+        self.lbas = array("q")
+        self.speeds = array("d")
+        # Running sums for the least squares fit of speed over lba
+        self._sx = self._sy = self._sxx = self._sxy = 0.0
+
+    def __len__(self):
+        return len(self.speeds)
+
+    def add(self, start_block: int, end_block: int, duration: float) -> bool:
+        """
+        Record a slice
+
+        :return: Whether the slice is slow compared to the slices before it
+        """
+        speed = (end_block - start_block) / max(duration, 1e-9)
+        lba = (start_block + end_block) // 2
+        slow = len(self) >= self.window // 2 and speed < self.slow_ratio * self.recent_speed()
+
+        self.lbas.append(lba)
+        self.speeds.append(speed)
+        self._sx += lba
+        self._sy += speed
+        self._sxx += lba * lba
+        self._sxy += lba * speed
+        return slow
+
+    def recent_speed(self) -> float:
+        return statistics.median(self.speeds[-self.window:])
+
+    def average(self) -> float:
+        return self._sy / len(self)
+
+    def eta(self, pos: int, end: int, steps: int = 64) -> float:
+        """
+        Estimate the remaining seconds by integrating the fitted throughput curve from pos to end
+
+        :param pos: Current block
+        :param end: Last block
+        """
+        recent = self.recent_speed()
+        n = len(self)
+        denom = n * self._sxx - self._sx * self._sx
+        if n < self.window or denom <= 0:
+            return (end - pos) / recent
+
+        slope = (n * self._sxy - self._sx * self._sy) / denom
+        # Anchor the curve at the current throughput, and never let it drop unreasonably low
+        step = (end - pos) / steps
+        floor = recent * 0.3
+        return sum(step / max(recent + slope * (i + 0.5) * step, floor) for i in range(steps))
+
+    @staticmethod
+    def slow_slices(speeds: list[float], window: int = 16, slow_ratio: float = 0.5) -> list[int]:
+        """
+        Find slices much slower than the median of the slices around them
+
+        :return: Indices of slow slices
+        """
+        half = window // 2
+        return [i for i, v in enumerate(speeds)
+                if v < slow_ratio * statistics.median(speeds[max(0, i - half):i + half + 1])]
+
+
+class DiskScan:
+    """
+    Scan state of one disk
+    """
+    def __init__(self, disk: str, block_size: int, fsync: str = "interval", engine: str = "badblocks"):
+        self.disk = disk
+        self.block_size = block_size
+        self.engine = engine
+        self.verifier: NativeVerifier | None = None
+        self.log_file = Path(__file__).parent / f"badblocks_log_{disk.replace('/', '_')}.jsonl"
+        self.store = LogStore(self.log_file, fsync)
+        self.telemetry = Telemetry()
+        self.disk_size = 0
+        self.lss = 0
+        self.pos = 0
+        self.done = False
+
+    def to_gb(self, block: int):
+        return block * self.block_size / (1024 * 1024 * 1024)
+
+    def disk_info(self) -> tuple[int, int]:
+        # Get the disk size in blocks
+        disk_size = int(subprocess.run(f"blockdev --getsize64 {self.disk}", capture_output=True, text=True, shell=True).stdout) // self.block_size
+        log.info(f"[{self.disk}] Disk size: {self.to_gb(disk_size):,.0f} GB, {disk_size:#x} blocks")
+
+        # Get the size of a logical sector (LDA)
+        lss = int(subprocess.run(f"blockdev --getss {self.disk}", capture_output=True, text=True, shell=True).stdout)
+        pss = int(subprocess.run(f"blockdev --getpbsz {self.disk}", capture_output=True, text=True, shell=True).stdout)
+        log.info(f"[{self.disk}] Logical sector size: {lss} bytes, physical sector size: {pss} bytes")
+
+        self.disk_size, self.lss = disk_size, lss
+        return disk_size, lss
+
+    def init_log(self, rescan: bool) -> int | None:
+        """
+        Create the log file, or check it and find where to resume from
+
+        :return: Block to resume from, or None to start from the beginning
+        """
+        if not self.store.exists():
+            self.store.create(self.block_size)
+            self.migrate_legacy_log()
+        if rescan:
+            return None
+
+        # Check if the block size matches
+        block_size = self.store.header()["block_size"]
+        if block_size != self.block_size:
+            raise ValueError(f"Block size mismatch: {block_size} != {self.block_size}")
+
+        # Resume from the last run
+        last_log = self.store.tail()
+        if last_log:
+            start = last_log["end_block"]
+            log.info(f"[{self.disk}] Resuming from {start:#x}")
+            return start
+        return None
+
+    def migrate_legacy_log(self):
+        """
+        Import the records of an old json log (which was rewritten entirely after every slice)
+        """
+        legacy = self.log_file.with_suffix(".json")
+        if not legacy.exists():
+            return
+        logf = json.loads(legacy.read_text())
+        if logf["block_size"] != self.block_size:
+            raise ValueError(f"Block size mismatch: {logf['block_size']} != {self.block_size}")
+        for r in logf["logs"]:
+            self.store.append(r)
+        self.store.close()
+        log.info(f"[{self.disk}] Imported {len(logf['logs'])} records from {legacy}")
+
+    def run_badblocks(self, start_block: int, end_block: int) -> float:
+        """
+        Scan one slice, log the result and print progress
+
+        :return: Duration in seconds
+        """
+        # Print block address in hex
+        log.debug(f"[{self.disk}] Scanning from {start_block:#x} ({self.to_gb(start_block):,.0f} GB) to {end_block:#x} ({self.to_gb(end_block):,.0f} GB)")
+
+        duration = time.time()
+        if self.engine == "native":
+            if self.verifier is None:
+                self.verifier = NativeVerifier(self.disk, self.block_size)
+            bad_blocks, stderr = self.verifier.verify(start_block, end_block)
+        else:
+            # badblocks takes an inclusive last block
+            command = f"badblocks -b {self.block_size} -v {self.disk} {end_block - 1} {start_block}"
+            result = subprocess.run(command, capture_output=True, text=True, shell=True, start_new_session=True)
+
+            # stdout should be a list of bad blocks, parse it
+            bad_blocks = [int(r) for r in result.stdout.strip().split("\n") if r]
+            stderr = result.stderr
+        duration = time.time() - duration
+
+        # Append the log record
+        self.store.append({
+            "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "duration": duration,
+            "start_block": start_block,
+            "end_block": end_block,
+            "bad_blocks": bad_blocks,
+            "stderr": stderr,
+        })
+
+        # Print logs
+        if bad_blocks:
+            log.error(f"[{self.disk}] > Bad blocks found: ")
+            for block in bad_blocks:
+                # Pint in hex
+                log.error(f"[{self.disk}] > {block:#x} = LDA {block * self.block_size // self.lss:#x} = {self.to_gb(block):,.0f} GB")
+        else:
+            log.debug(color(f"[{self.disk}] > Clean!"))
+
+        # Print summary (speed, progress, eta, etc.)
+        # The stored speed is in blocks per second
+        slow = self.telemetry.add(start_block, end_block, duration)
+        speed = self.telemetry.speeds[-1]
+        avg_spd = self.telemetry.average()
+        self.pos = end_block
+        progress = end_block / self.disk_size
+
+        # Calculate ETA from the throughput curve
+        eta = self.telemetry.eta(end_block, self.disk_size)
+        eta = str(datetime.timedelta(seconds=eta))[:-7]
+
+        # Convert speed to MB/s
+        to_mbs = self.block_size / (1024 * 1024)
+        if slow:
+            log.warning(f"[{self.disk}] > Slow region at {start_block:#x} ({self.to_gb(start_block):,.0f} GB): "
+                        f"{speed * to_mbs:.1f} MB/s, recent median {self.telemetry.recent_speed() * to_mbs:.1f} MB/s")
+        speed *= to_mbs
+        avg_spd *= to_mbs
+
+        log.info(f"[{self.disk}] > {progress * 100:.2f}% | Cur {speed:.1f} MB/s | Remain {eta} | "
+                 f"Avg {avg_spd:.1f} MB/s")
+        if len(scans) > 1:
+            log_total()
+        return duration
+
+    def scan(self, start: int, end: int, slice_blocks: int, slice_seconds: float | None = None):
+        """
+        Scan a range of blocks slice by slice
+
+        :param slice_blocks: Size of a slice (initial size if slice_seconds is set)
+        :param slice_seconds: Adapt the slice size to the observed throughput so that each slice
+            takes about this long, None for fixed slices
+        """
+        # Adaptive slices stay between 64 MiB and 16 GiB
+        min_blocks = 64 * 1024 * 1024 // self.block_size
+        max_blocks = 16 * 1024 * 1024 * 1024 // self.block_size
+
+        self.pos = start
+        try:
+            pos = start
+            while pos < end:
+                n = min(slice_blocks, end - pos)
+                duration = self.run_badblocks(pos, pos + n)
+                pos += n
+                if slice_seconds and duration > 0:
+                    # Change the size by at most 2x at a time so a single outlier doesn't throw it off
+                    target = n * slice_seconds / duration
+                    slice_blocks = int(min(max(target, n / 2, min_blocks), n * 2, max_blocks))
+                if pending_stop:
+                    break
+        except Exception as e:
+            log.exception(f"[{self.disk}] Scan failed: {e}")
+        finally:
+            if self.verifier is not None:
+                self.verifier.close()
+                self.verifier = None
+            self.store.close()
+            self.done = True
+
+
+def log_total():
+    """
+    Print aggregated throughput and ETA over all disks being scanned
+    """
+    with scans_lock:
+        active = [s for s in scans if len(s.telemetry) and not s.done]
+        # Bytes per second of the disks that are currently scanning
+        total_spd = sum(s.telemetry.speeds[-1] * s.block_size for s in active)
+        remain = sum((s.disk_size - s.pos) * s.block_size for s in scans)
+        total = sum(s.disk_size * s.block_size for s in scans)
+
+    if not total_spd or not total:
+        return
+    eta = str(datetime.timedelta(seconds=remain / total_spd))[:-7]
+    log.info(f"[All {len(scans)} disks] > {(1 - remain / total) * 100:.2f}% | {len(active)} active | "
+             f"Total {total_spd / (1024 * 1024):.1f} MB/s | Remain {eta}")
+
+
+# Number of bins in the html block map, independent of the disk size
+REPORT_BINS = 4096
+# Maximum number of individual bad block addresses listed in the report
+REPORT_MAX_BAD_BLOCKS = 1000
+
+
+def load_log(path: Path) -> tuple[int, list[dict]]:
+    """
+    Read a scan log, either the JSONL log or an old json log
+
+    :return: Block size, records
+    """
+    if path.suffix == ".json":
+        logf = json.loads(path.read_text())
+        return logf["block_size"], logf["logs"]
+    store = LogStore(path)
+    return store.header()["block_size"], store.records()
+
+
+def aggregate_scan(records: list[dict], disk_blocks: int, block_size: int, bins: int = REPORT_BINS) -> dict:
+    """
+    Downsample a scan log into a fixed number of bins over the disk, so that the report size doesn't
+    depend on the disk size or the number of slices.
+
+    The bins are packed as little-endian arrays (float32 min MB/s, float32 avg MB/s, uint32 bad
+    block count, uint8 scanned percentage, uint8 flags with bit 0 = slow region) and base64 encoded.
+    """
+    bin_blocks = max(1, -(-disk_blocks // bins))
+    n = -(-disk_blocks // bin_blocks)
+    to_mbs = block_size / (1024 * 1024)
+
+    covered, seconds, mins, bad = [0] * n, [0.0] * n, [float("inf")] * n, [0] * n
+    bad_blocks = []
+    for r in records:
+        start, end = r["start_block"], min(r["end_block"], disk_blocks)
+        if end <= start:
+            continue
+        speed = (r["end_block"] - r["start_block"]) / max(r["duration"], 1e-9)
+        for b in range(start // bin_blocks, (end - 1) // bin_blocks + 1):
+            overlap = min(end, (b + 1) * bin_blocks) - max(start, b * bin_blocks)
+            covered[b] += overlap
+            seconds[b] += overlap / speed
+            mins[b] = min(mins[b], speed)
+        for block in r["bad_blocks"]:
+            bad[min(block // bin_blocks, n - 1)] += 1
+        bad_blocks += r["bad_blocks"]
+
+    avg = [c / t * to_mbs if t else 0 for c, t in zip(covered, seconds)]
+    scanned = [i for i in range(n) if covered[i]]
+    slow = set(scanned[i] for i in Telemetry.slow_slices([avg[i] for i in scanned]))
+
+    packed = [
+        array("f", [m * to_mbs if covered[i] else 0 for i, m in enumerate(mins)]),
+        array("f", avg),
+        array("I", bad),
+        array("B", [min(100, round(c * 100 / (min((i + 1) * bin_blocks, disk_blocks) - i * bin_blocks)))
+                    for i, c in enumerate(covered)]),
+        array("B", [1 if i in slow else 0 for i in range(n)]),
+    ]
+    if sys.byteorder == "big":
+        for a in packed:
+            a.byteswap()
+
+    return {
+        "first": records[0]["timestamp"] if records else None,
+        "last": records[-1]["timestamp"] if records else None,
+        "bins": n,
+        "bin_blocks": bin_blocks,
+        "data": base64.b64encode(b"".join(a.tobytes() for a in packed)).decode(),
+        "bad_total": len(bad_blocks),
+        "bad_blocks": sorted(set(bad_blocks))[:REPORT_MAX_BAD_BLOCKS],
+    }
+
+
+def plot(scan: DiskScan, compare: list[Path] | None = None):
+    """
+    Generate the html report of a disk
+
+    :param compare: Older logs of the same disk to show alongside the current scan
+    """
+    logs = [(p.name, *load_log(p)) for p in (compare or [])] + [(scan.log_file.name, scan.block_size, scan.store.records())]
+    for name, block_size, _ in logs:
+        if block_size != scan.block_size:
+            raise ValueError(f"Block size mismatch in {name}: {block_size} != {scan.block_size}")
+
+    disk_blocks = max([scan.disk_size] + [r["end_block"] for _, _, records in logs for r in records[-1:]])
+    report = {
+        "disk": scan.disk,
+        "block_size": scan.block_size,
+        "disk_blocks": disk_blocks,
+        "scans": [{"name": name, **aggregate_scan(records, disk_blocks, scan.block_size)} for name, _, records in logs],
+    }
+
+    ouf = Path(f"badblocks{scan.disk.replace('/', '_')}.html")
+    html = ((Path(__file__).parent / 'badblocks.html').read_text()
+        .replace("d: null", f"d: {json.dumps(report)}")
+        .replace("/dev/sda", scan.disk)
+    )
+    ouf.write_text(html)
+    log.info(f"Results saved to {ouf}.")
+    log.warning(f"You can open the html {ouf.absolute().as_uri()} in your browser. I can't open it for you because this script is running in sudo.")
 
 
 if __name__ == "__main__":
     # Take in disk and block size as optional arguments
     parser = argparse.ArgumentParser("Bad block detection utility")
-    parser.add_argument("command", type=str, help="Command to run", choices=["scan", "plot"])
-    parser.add_argument("--disk", "-d", type=str, help="Disk to scan")
+    parser.add_argument("command", type=str, help="Command to run", choices=["scan", "plot", "compact"])
+    parser.add_argument("--disk", "-d", type=str, action="append", help="Disk to scan (can be given multiple times)")
     parser.add_argument("--block-size", "-b", type=int, default=4096, help="Block size in bytes")
     parser.add_argument("--start", "-s", type=int, help="Start block")
     parser.add_argument("--end", "-e", type=int, help="End block")
     parser.add_argument("--rescan", action="store_true", help="Rescan the whole disk")
+    parser.add_argument("--concurrency", "-j", type=int, default=4, help="Maximum number of disks scanned at the same time")
+    parser.add_argument("--fsync", type=str, default="interval", choices=["always", "interval", "never"],
+                        help="When to fsync the log (interval = at most every 10 seconds)")
+    parser.add_argument("--engine", type=str, default="badblocks", choices=["badblocks", "native"],
+                        help="Scan with the badblocks binary, or with the built-in read-only O_DIRECT reader")
+    parser.add_argument("--slice-seconds", type=float, help="Adapt the slice size so that each slice takes about this long")
+    parser.add_argument("--compare", type=Path, nargs="+", help="Older logs of the same disk to compare with in the report")
     args = parser.parse_args()
 
-    DISK = args.disk
+    DISKS = args.disk or []
     BLOCK_SIZE = args.block_size
     START = args.start
     END = args.end
 
     try:
         assert platform.system() != "Windows", "Windows is not supported, go use DiskGenius or something"
-        assert which("badblocks"), "badblocks command not found, please install e2fsprogs"
+        assert args.engine == "native" or which("badblocks"), "badblocks command not found, please install e2fsprogs"
         assert which("blockdev"), "blockdev command not found, please install util-linux"
-        assert DISK and Path(DISK).exists(), f"Disk {DISK} does not exist"
+        assert DISKS, "Please specify at least one disk"
+        for DISK in DISKS:
+            assert Path(DISK).exists(), f"Disk {DISK} does not exist"
         assert BLOCK_SIZE % 512 == 0, "Block size must be a multiple of 512"
+        assert args.concurrency > 0, "Concurrency must be positive"
         assert os.geteuid() == 0, "You need to run as root to access the disk"
     except AssertionError as e:
         log.error(e.args[0])
         exit(1)
 
-    LOG_FILE = Path(__file__).parent / f"badblocks_log_{DISK.replace('/', '_')}.json"
-
-    if not LOG_FILE.exists():
-        LOG_FILE.write_text(json.dumps({"logs": [], "block_size": BLOCK_SIZE}, indent=2))
-    elif not args.rescan:
-        # Check if the block size matches
-        block_size = json.loads(LOG_FILE.read_text())["block_size"]
-        if block_size != BLOCK_SIZE:
-            raise ValueError(f"Block size mismatch: {block_size} != {BLOCK_SIZE}")
-
-        # Resume from the last run
-        logs = json.loads(LOG_FILE.read_text())["logs"]
-        if logs:
-            last_log = logs[-1]
-            START = last_log["end_block"]
-            log.info(f"Resuming from {START:#x}")
-
     gb_approx = 1024 * 1024 * 1024 // BLOCK_SIZE
-    disk_size, lss = disk_info()
+    starts = {}
+    for DISK in DISKS:
+        scan = DiskScan(DISK, BLOCK_SIZE, args.fsync, args.engine)
+        resume = scan.init_log(args.rescan)
+        scan.disk_info()
+        scans.append(scan)
+        starts[DISK] = resume if resume is not None else START
 
     if args.command == "scan":
-        for start in range(START or 0, END or disk_size, gb_approx):
-            end = min(start + gb_approx, disk_size)
-            run_badblocks(start, end)
-            if pending_stop:
-                break
-    
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            for scan in scans:
+                pool.submit(scan.scan, starts[scan.disk] or 0, END or scan.disk_size, gb_approx, args.slice_seconds)
+
+    if args.command == "compact":
+        for scan in scans:
+            scan.store.compact()
+            log.info(f"[{scan.disk}] Compacted {scan.log_file}")
+
     # Plot
-    ouf = Path(f"badblocks{DISK.replace('/', '_')}.html")
-    html = ((Path(__file__).parent / 'badblocks.html').read_text()
-        .replace("d: { logs: [] }", f"d: {LOG_FILE.read_text()}")
-        .replace("/dev/sda", DISK)
-    )
-    ouf.write_text(html)
-    log.info(f"Results saved to {ouf}.")
-    log.warning(f"You can open the html {ouf.absolute().as_uri()} in your browser. I can't open it for you because this script is running in sudo.")
+    for scan in scans:
+        plot(scan, args.compare)
@@ -1,3 +1,10 @@
+from __future__ import annotations
+
+import functools
+import os
+import re
+import sys
+from typing import Iterable
 
 
 def ansi_rgb(r: int, g: int, b: int, foreground: bool = True) -> str:
@@ -22,37 +29,328 @@ replacements = ["&0/\033[0;30m", "&1/\033[0;34m", "&2/\033[0;32m", "&3/\033[0;36
 replacements = [(r[:2], r[3:]) for r in replacements]
 
 
-def color(msg: str) -> str:
+# Escape code (or stripped replacement) of each character that can follow '&'
+_codes = {code[1]: esc for code, esc in replacements}
+_stripped = {c: '\n' if c == '-' else '' for c in _codes}
+
+
+@functools.lru_cache(maxsize=1024)
+def _gradient(code: str, foreground: bool) -> str:
+    code = code.strip()
+    if code.startswith('#'):
+        rgb = tuple(int(code.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
+    else:
+        rgb = tuple(int(c) for c in re.split(r'[,; ]+', code))
+    return ansi_rgb(*rgb, foreground=foreground)
+
+
+@functools.lru_cache(maxsize=4096)
+def _color(msg: str, strip: bool) -> str:
+    # Single pass over the '&'-separated pieces, each piece starts with the code character
+    codes = _stripped if strip else _codes
+    parts = msg.split('&')
+    out = [parts[0]]
+    for p in parts[1:]:
+        esc = codes.get(p[:1])
+        if esc is not None:
+            out.append(esc)
+            out.append(p[1:])
+        elif p[:3] in ('gf(', 'gb(') and ')' in p:
+            end = p.index(')')
+            out.append('' if strip else _gradient(p[3:end], p[1] == 'f'))
+            out.append(p[end + 1:])
+        else:
+            out.append('&')
+            out.append(p)
+    return ''.join(out)
+
+
+def color_enabled(stream=None) -> bool:
+    """
+    Whether colors should be printed to a stream: disabled if the NO_COLOR environment variable is set
+    (https://no-color.org) or the stream is not a terminal
+
+    :param stream: Output stream (defaults to stdout)
+    """
+    stream = stream or sys.stdout
+    if os.environ.get('NO_COLOR'):
+        return False
+    return hasattr(stream, 'isatty') and stream.isatty()
+
+
+def color(msg: str, strip: bool = False) -> str:
     """
     Replace extended minecraft color codes in string
 
+    Translated messages are cached, so repeated templates are only parsed once.
+
     :param msg: Message with minecraft color codes
+    :param strip: Remove the color codes instead of replacing them with escape codes
     :return: Message with escape codes
     """
-    for code, esc in replacements:
-        msg = msg.replace(code, esc)
+    if '&' not in msg:
+        return msg
+    return _color(msg, strip)
 
-    while '&gf(' in msg or '&gb(' in msg:
-        i = msg.index('&gf(') if '&gf(' in msg else msg.index('&gb(')
-        end = msg.index(')', i)
-        code = msg[i + 4:end]
-        fore = msg[i + 2] == 'f'
 
-        if code.startswith('#'):
-            rgb = tuple(int(code.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
-        else:
-            code = code.replace(',', ' ').replace(';', ' ').replace('  ', ' ')
-            rgb = tuple(int(c) for c in code.split(' '))
+def printc(msg: str, strip: bool | None = None):
+    """
+    Print with color
 
-        msg = msg[:i] + ansi_rgb(*rgb, foreground=fore) + msg[end + 1:]
+    :param msg: Message with minecraft color codes
+    :param strip: Print without colors, by default only when color_enabled() is false
+    """
+    if strip is None:
+        strip = not color_enabled()
+    print(color(msg + '&r', strip))
 
-    return msg
 
+# Color rendering for gradients and tables (requires numpy). Modes are 'truecolor', '256', '16', or None for no color
+COLOR_MODES = ('truecolor', '256', '16')
+# xterm default rgb of the 16 basic colors, in SGR order (30-37, then bright 90-97)
+ansi_16_rgb = [(0, 0, 0), (205, 0, 0), (0, 205, 0), (205, 205, 0), (0, 0, 238), (205, 0, 205), (0, 205, 205),
+               (229, 229, 229), (127, 127, 127), (255, 0, 0), (0, 255, 0), (255, 255, 0), (92, 92, 255),
+               (255, 0, 255), (0, 255, 255), (255, 255, 255)]
+# Bits kept per channel when looking up the nearest palette color
+LUT_BITS = 5
 
-def printc(msg: str):
+
+def color_mode(stream=None) -> str | None:
     """
-    Print with color
+    Guess the color mode of a terminal from COLORTERM and TERM
 
-    :param msg: Message with minecraft color codes
+    :param stream: Output stream (defaults to stdout)
+    :return: 'truecolor', '256', '16', or None if colors are disabled (see color_enabled)
+    """
+    if not color_enabled(stream):
+        return None
+    if os.environ.get('COLORTERM', '').lower() in ('truecolor', '24bit'):
+        return 'truecolor'
+    return '256' if '256color' in os.environ.get('TERM', '') else '16'
+
+
+def _rgb_array(colors: Iterable[str | tuple[int, int, int]]):
+    import numpy as np
+    return np.array([tuple(int(c.lstrip('#')[i:i+2], 16) for i in (0, 2, 4)) if isinstance(c, str) else c
+                     for c in colors], dtype=float).reshape(-1, 3)
+
+
+def _interp(t, stops):
+    import numpy as np
+    xp = np.arange(len(stops))
+    return np.stack([np.interp(t, xp, stops[:, c]) for c in range(3)], axis=-1).round().astype(np.uint8)
+
+
+def gradient(colors: Iterable[str | tuple[int, int, int]], n: int):
+    """
+    Interpolate n colors evenly spaced between color stops
+
+    :param colors: Color stops as hex strings ("#ff8800") or rgb tuples
+    :param n: Number of colors
+    :return: uint8 array of shape (n, 3)
     """
-    print(color(msg + '&r'))
+    import numpy as np
+    stops = _rgb_array(colors)
+    return _interp(np.linspace(0, len(stops) - 1, n), stops)
+
+
+def colormap(values, colors: Iterable[str | tuple[int, int, int]], vmin: float | None = None,
+             vmax: float | None = None):
+    """
+    Map values linearly onto color stops (NaN maps to the first stop)
+
+    :param values: Array-like of numbers, of any shape
+    :param colors: Color stops as hex strings or rgb tuples, from vmin to vmax
+    :param vmin: Value of the first stop (defaults to the minimum)
+    :param vmax: Value of the last stop (defaults to the maximum)
+    :return: uint8 array of shape values.shape + (3,)
+    """
+    import numpy as np
+    v = np.asarray(values, dtype=float)
+    stops = _rgb_array(colors)
+    vmin = np.nanmin(v) if vmin is None else vmin
+    vmax = np.nanmax(v) if vmax is None else vmax
+    t = np.clip((v - vmin) / ((vmax - vmin) or 1), 0, 1)
+    return _interp(np.nan_to_num(t) * (len(stops) - 1), stops)
+
+
+@functools.lru_cache(maxsize=None)
+def _palette(mode: str):
+    import numpy as np
+    if mode == '16':
+        return np.array(ansi_16_rgb, dtype=np.int32)
+    # 256 colors: the 16 basic colors, a 6x6x6 cube, and 24 grays
+    levels = [0, 95, 135, 175, 215, 255]
+    cube = [(r, g, b) for r in levels for g in levels for b in levels]
+    grays = [(v, v, v) for v in range(8, 248, 10)]
+    return np.array(ansi_16_rgb + cube + grays, dtype=np.int32)
+
+
+@functools.lru_cache(maxsize=None)
+def _palette_lut(mode: str):
+    """
+    Nearest palette index of every rgb color truncated to LUT_BITS per channel
+    """
+    import numpy as np
+    palette = _palette(mode)
+    # The basic colors are configurable in most terminals, so 256 color mode only maps onto the cube and grays
+    first = 16 if mode == '256' else 0
+    levels = (np.arange(1 << LUT_BITS) << (8 - LUT_BITS)) + (1 << (7 - LUT_BITS))
+    grid = np.stack(np.meshgrid(levels, levels, levels, indexing='ij'), axis=-1).reshape(-1, 3)
+    lut = np.empty(len(grid), dtype=np.uint8)
+    for i in range(0, len(grid), 4096):
+        d = ((grid[i:i + 4096, None, :] - palette[None, first:, :]) ** 2).sum(axis=-1)
+        lut[i:i + 4096] = d.argmin(axis=1) + first
+    return lut
+
+
+def quantize(rgb, mode: str):
+    """
+    Map rgb colors to the nearest color of a limited palette
+
+    :param rgb: uint8 array of shape (..., 3)
+    :param mode: '256' or '16'
+    :return: uint8 array of palette indices, of shape rgb.shape[:-1]
+    """
+    import numpy as np
+    rgb = np.asarray(rgb, dtype=np.uint8) >> (8 - LUT_BITS)
+    idx = (rgb[..., 0].astype(np.int32) << (2 * LUT_BITS)) | (rgb[..., 1].astype(np.int32) << LUT_BITS) | rgb[..., 2]
+    return _palette_lut(mode)[idx]
+
+
+@functools.lru_cache(maxsize=None)
+def _palette_escapes(mode: str, foreground: bool) -> list[str]:
+    if mode == '256':
+        return [f'\033[{38 if foreground else 48};5;{i}m' for i in range(256)]
+    base = 30 if foreground else 40
+    return [f'\033[{base + i if i < 8 else base + 60 + i - 8}m' for i in range(16)]
+
+
+def render(text: str | list[str], rgb, mode: str | None = 'truecolor', foreground: bool = True,
+           width: int | None = None) -> str:
+    """
+    Color each character (or each string of a list) of text, emitting an escape code only where the
+    color changes
+
+    :param text: String, or list of strings that each get one color
+    :param rgb: uint8 array of shape (len(text), 3)
+    :param mode: 'truecolor', '256', '16', or None to return the text without colors
+    :param foreground: Color the text (True) or its background (False)
+    :param width: Break the line (and reset the color) after every width items
+    :return: Colored text, reset at the end of each line
+    """
+    import numpy as np
+    n = len(text)
+    width = width or n
+    if mode is None or not n:
+        return '\n'.join(''.join(text[i:i + width]) for i in range(0, n, width))
+    rgb = np.asarray(rgb, dtype=np.uint8).reshape(-1, 3)
+    if mode == 'truecolor':
+        keys = (rgb[:, 0].astype(np.int32) << 16) | (rgb[:, 1].astype(np.int32) << 8) | rgb[:, 2]
+    else:
+        keys = quantize(rgb, mode)
+        escapes = _palette_escapes(mode, foreground)
+
+    # Start of each run of identical colors, a new line always starts a new run
+    change = np.ones(n, dtype=bool)
+    change[1:] = keys[1:] != keys[:-1]
+    change[::width] = True
+    starts = np.flatnonzero(change).tolist()
+    out = []
+    for start, end, key in zip(starts, starts[1:] + [n], keys[starts].tolist()):
+        if start and start % width == 0:
+            out.append('\033[0m\n')
+        out.append(ansi_rgb(key >> 16, (key >> 8) & 255, key & 255, foreground) if mode == 'truecolor' else escapes[key])
+        out.append(''.join(text[start:end]))
+    out.append('\033[0m')
+    return ''.join(out)
+
+
+def gradient_text(text: str, colors: Iterable[str | tuple[int, int, int]], mode: str | None = 'truecolor',
+                  foreground: bool = True) -> str:
+    """
+    Color text with a gradient between color stops
+
+    >>> print(gradient_text('Hello world', ['#ff0080', '#00c0ff']))
+    """
+    return render(text, gradient(colors, len(text)), mode, foreground)
+
+
+def heatmap(values, colors: Iterable[str | tuple[int, int, int]] = ('#22c55e', '#eab308', '#ef4444'),
+            fmt: str = '{:>8.1f}', mode: str | None = 'truecolor', vmin: float | None = None,
+            vmax: float | None = None, foreground: bool = True) -> str:
+    """
+    Format a 2d table of values with each cell colored by its value
+
+    :param values: 2d array-like of numbers
+    :param colors: Color stops from vmin to vmax
+    :param fmt: Format of each cell
+    :param mode: Color mode, see render
+    :param vmin: Value of the first color (defaults to the minimum)
+    :param vmax: Value of the last color (defaults to the maximum)
+    :param foreground: Color the text (True) or the cell background (False)
+    :return: Lines of the table
+    """
+    import numpy as np
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    cells = [fmt.format(v) for v in values.ravel().tolist()]
+    return render(cells, colormap(values, colors, vmin, vmax), mode, foreground, width=values.shape[1])
+
+
+if __name__ == '__main__':
+    from hypy_utils import run_time
+
+    def legacy_color(msg: str) -> str:
+        for code, esc in replacements:
+            msg = msg.replace(code, esc)
+        while '&gf(' in msg or '&gb(' in msg:
+            i = msg.index('&gf(') if '&gf(' in msg else msg.index('&gb(')
+            end = msg.index(')', i)
+            code = msg[i + 4:end]
+            if code.startswith('#'):
+                rgb = tuple(int(code.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
+            else:
+                code = code.replace(',', ' ').replace(';', ' ').replace('  ', ' ')
+                rgb = tuple(int(c) for c in code.split(' '))
+            msg = msg[:i] + ansi_rgb(*rgb, foreground=msg[i + 2] == 'f') + msg[end + 1:]
+        return msg
+
+    samples = ['&a[INFO] &rServer started on port &e8080', '&c&lERROR&r: &gf(#ff8800)disk &gb(10, 20, 30)/dev/sda&r',
+               '&&0 &-next line &gf(1;2;3)rgb', 'plain line without codes']
+    for s in samples:
+        assert color(s) == legacy_color(s), s
+    assert color(samples[1], strip=True) == 'ERROR: disk /dev/sda'
+
+    lines = [f'&7[{i:06d}] &a[INFO] &rProcessed &e{i}&r items from &gf(#44aaff)worker-{i % 8}&r' for i in range(100000)]
+    templates = ['&7[&a INFO &7] &rProcessed items from &gf(#44aaff)worker&r'] * 100000
+
+    def legacy_unique_lines(): return [legacy_color(s) for s in lines]
+    def color_unique_lines(): return [color(s) for s in lines]
+    def legacy_templates(): return [legacy_color(s) for s in templates]
+    def color_templates(): return [color(s) for s in templates]
+    run_time(legacy_unique_lines, iter=3)
+    run_time(color_unique_lines, iter=3)
+    run_time(legacy_templates, iter=3)
+    run_time(color_templates, iter=3)
+
+    import numpy as np
+    table = np.random.default_rng(0).normal(100, 20, (40, 15))
+    stops = ['#22c55e', '#eab308', '#ef4444']
+    rgb = colormap(table, stops)
+    assert quantize(rgb, '256').max() < 256 and quantize(rgb, '16').max() < 16
+
+    def naive_heatmap():
+        return '\n'.join(''.join(ansi_rgb(*rgb[i, j]) + f'{v:>8.1f}' for j, v in enumerate(row)) + '\033[0m'
+                         for i, row in enumerate(table.tolist()))
+    def truecolor_heatmap(): return heatmap(table, stops)
+    def palette_256_heatmap(): return heatmap(table, stops, mode='256')
+    def palette_16_heatmap(): return heatmap(table, stops, mode='16')
+    banner = 'HyPyUtils dashboard ' * 10
+    def naive_gradient(): return ''.join(ansi_rgb(*c) + ch for c, ch in zip(gradient(stops, len(banner)), banner))
+    def rendered_gradient(): return gradient_text(banner, stops, mode='256')
+    run_time(naive_heatmap, iter=100)
+    run_time(truecolor_heatmap, iter=100)
+    run_time(palette_256_heatmap, iter=100)
+    run_time(palette_16_heatmap, iter=100)
+    run_time(naive_gradient, iter=100)
+    run_time(rendered_gradient, iter=100)
@@ -1,24 +1,29 @@
 from __future__ import annotations
 
+import json
+import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from typing import BinaryIO
 
 import requests
+from requests.adapters import HTTPAdapter
 import tqdm
 
+from .serializer import hash_file
 
-def download_file(url: str, file: str | Path, progress: bool = True):
-    """
-    Helper method handling downloading large files from `url` to `filename`.
-    Returns a pointer to `filename`.
-    https://stackoverflow.com/a/42071418/7346633
-    """
-    file = Path(file)
-    if file.is_file():
-        return file
+log = logging.getLogger(__name__)
 
-    chunk_size = 1024
+# Files smaller than this are downloaded in one request
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+# Compressed transfers would make content-length differ from the size on disk
+HEADERS = {'Accept-Encoding': 'identity'}
 
+
+def _progress_bar(file: Path, total: int | None) -> tqdm.tqdm:
     try:
         term_len = os.get_terminal_size().columns
         bar_len = int(term_len * 0.4)
@@ -27,21 +32,319 @@ def download_file(url: str, file: str | Path, progress: bool = True):
         bar_len = 20
 
     tqdm_args = dict()
-    r = requests.get(url, stream=True)
-    if 'content-length' in r.headers:
-        tqdm_args['total'] = int(r.headers['content-length']) / 1024 / 1024
-
-    with open(file, 'wb') as f:
-        pbar = None
-        if progress:
-            pbar = tqdm.tqdm(unit=" MB", ncols=term_len,
-                             bar_format='{desc} {rate_noinv_fmt} {remaining} [{bar}] {percentage:.0f}%', ascii=' #',
-                             desc=file.name[:bar_len].ljust(bar_len), **tqdm_args)
-
-        for chunk in r.iter_content(chunk_size=chunk_size):
-            if chunk:
-                if pbar:
-                    pbar.update(len(chunk) / 1024 / 1024)
+    if total:
+        tqdm_args['total'] = total / 1024 / 1024
+
+    return tqdm.tqdm(unit=" MB", ncols=term_len,
+                     bar_format='{desc} {rate_noinv_fmt} {remaining} [{bar}] {percentage:.0f}%', ascii=' #',
+                     desc=file.name[:bar_len].ljust(bar_len), **tqdm_args)
+
+
+class RateLimiter:
+    """
+    Token bucket shared between threads to cap the total bandwidth
+    """
+    def __init__(self, rate: float, burst: float | None = None):
+        """
+        :param rate: Bytes per second
+        :param burst: Bytes that can be sent at once after being idle (defaults to one second worth)
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n: int):
+        """
+        Take n bytes from the bucket, sleeping if the rate is exceeded
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def _report(n: int, pbar: tqdm.tqdm | None, limiter: RateLimiter | None):
+    if pbar is not None:
+        pbar.update(n / 1024 / 1024)
+    if limiter:
+        limiter.consume(n)
+
+
+class _SegmentMap:
+    """
+    Progress of a partial download, saved next to the .part file so that it can be resumed
+    """
+    def __init__(self, path: Path, url: str, size: int | None, etag: str | None, segments: list[list[int]]):
+        self.path = path
+        self.info = {"url": url, "size": size, "etag": etag, "segments": segments}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: Path, url: str, size: int | None, etag: str | None) -> _SegmentMap | None:
+        """
+        :return: The saved map, or None if it doesn't exist or belongs to a different file version
+        """
+        if not path.is_file():
+            return None
+        try:
+            info = json.loads(path.read_text())
+        except ValueError:
+            return None
+        if (info["url"], info["size"], info["etag"]) != (url, size, etag):
+            return None
+        return cls(path, url, size, etag, info["segments"])
+
+    @property
+    def segments(self) -> list[list[int]]:
+        """
+        [start, end (exclusive), downloaded bytes] of each segment
+        """
+        return self.info["segments"]
+
+    def commit(self, i: int, done: int, f: BinaryIO):
+        """
+        Record the progress of segment i once its data is on disk, so that the saved map never runs
+        ahead of the data (the other segments only record what they have committed themselves)
+
+        :param done: Bytes of the segment written to f
+        :param f: File the segment is written to
+        """
+        f.flush()
+        os.fsync(f.fileno())
+        with self.lock:
+            self.segments[i][2] = done
+            self._save()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        # Write a temp file and rename, so that a crash leaves either the old or the new map
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(self.info))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+
+def _fetch_segment(session: requests.Session, url: str, part: Path, smap: _SegmentMap, i: int, chunk_size: int,
+                   pbar: tqdm.tqdm | None, limiter: RateLimiter | None):
+    start, end, done = smap.segments[i]
+    if start + done >= end:
+        return
+
+    r = session.get(url, headers={**HEADERS, 'Range': f'bytes={start + done}-{end - 1}'}, stream=True)
+    r.raise_for_status()
+    if r.status_code != 206:
+        raise IOError(f'Server ignored the range request for {url}')
+
+    written = 0
+    with open(part, 'r+b') as f:
+        f.seek(start + done)
+        try:
+            for chunk in r.iter_content(chunk_size=chunk_size):
                 f.write(chunk)
+                done += len(chunk)
+                _report(len(chunk), pbar, limiter)
+                written += len(chunk)
+                # Save the progress every 64 chunks
+                if written >= chunk_size * 64:
+                    smap.commit(i, done, f)
+                    written = 0
+        finally:
+            # Also save what was written when the connection drops
+            smap.commit(i, done, f)
+
+
+def _new_session(pool_size: int) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
-    return file
+
+def _download(url: str, file: Path, session: requests.Session, segments: int, chunk_size: int,
+              checksum: str | None, progress: bool, pbar: tqdm.tqdm | None,
+              limiter: RateLimiter | None) -> str | None:
+    """
+    Download into file.part and move it into place once verified
+
+    :return: ETag of the downloaded file
+    """
+    part = file.with_name(file.name + '.part')
+    map_path = file.with_name(file.name + '.part.json')
+    file.parent.mkdir(parents=True, exist_ok=True)
+
+    # A plain GET gives us the headers, and small files are streamed from it without a second request
+    r = session.get(url, headers=HEADERS, stream=True)
+    r.raise_for_status()
+    size = int(r.headers['content-length']) if 'content-length' in r.headers else None
+    etag = r.headers.get('etag')
+    ranges = r.headers.get('accept-ranges', '').lower() == 'bytes'
+
+    own_pbar = pbar is None and progress
+    if own_pbar:
+        pbar = _progress_bar(file, size)
+    try:
+        if ranges and size and (size >= MIN_SEGMENT_SIZE or part.is_file()):
+            r.close()
+            smap = _SegmentMap.load(map_path, url, size, etag) if part.is_file() else None
+            if smap is None:
+                n = max(1, min(segments, size // MIN_SEGMENT_SIZE))
+                bounds = [size * i // n for i in range(n + 1)]
+                smap = _SegmentMap(map_path, url, size, etag, [[s, e, 0] for s, e in zip(bounds, bounds[1:])])
+                with open(part, 'wb') as f:
+                    f.truncate(size)
+                smap.save()
+            elif pbar is not None:
+                pbar.update(sum(s[2] for s in smap.segments) / 1024 / 1024)
+
+            with ThreadPoolExecutor(len(smap.segments)) as pool:
+                futures = [pool.submit(_fetch_segment, session, url, part, smap, i, chunk_size, pbar, limiter)
+                           for i in range(len(smap.segments))]
+                for fut in futures:
+                    fut.result()
+        else:
+            with open(part, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    _report(len(chunk), pbar, limiter)
+    finally:
+        if own_pbar:
+            pbar.close()
+
+    # Verify before moving into place
+    if size is not None and part.stat().st_size != size:
+        raise IOError(f'Downloaded size {part.stat().st_size} of {file} does not match the expected {size}')
+    if checksum:
+        algo, expected = checksum.split(':', 1)
+        actual = hash_file(part, algo)
+        if actual.lower() != expected.lower():
+            part.unlink()
+            map_path.unlink(missing_ok=True)
+            raise IOError(f'Checksum mismatch for {file}: {algo} {actual} != {expected}')
+
+    os.replace(part, file)
+    map_path.unlink(missing_ok=True)
+    return etag
+
+
+def download_file(url: str, file: str | Path, progress: bool = True, segments: int = 4,
+                  session: requests.Session | None = None, chunk_size: int = 1024 * 1024,
+                  checksum: str | None = None, pbar: tqdm.tqdm | None = None,
+                  limiter: RateLimiter | None = None) -> Path:
+    """
+    Download a file from `url` to `file` and return the path.
+
+    Data is written to `file`.part and only renamed into place after the size (and optional checksum)
+    is verified, so an existing `file` is always complete. If the server supports range requests,
+    large files are fetched as several segments in parallel, and interrupted downloads resume from
+    the segment map saved in `file`.part.json.
+
+    :param url: URL to download
+    :param file: Destination path
+    :param progress: Whether to show a progress bar
+    :param segments: Number of parallel range requests for large files
+    :param session: Session to reuse connections from (a new pooled session is created if None)
+    :param chunk_size: Read size in bytes
+    :param checksum: Expected checksum as "algo:hexdigest" (e.g. "sha256:ab12..."), see serializer.hash_file
+    :param pbar: Shared progress bar to update (in MB) instead of creating one
+    :param limiter: Shared bandwidth limiter
+    :return: Path of the downloaded file
+    """
+    file = Path(file)
+    if file.is_file():
+        return file
+
+    own_session = session is None
+    if own_session:
+        session = _new_session(max(segments, 10))
+    try:
+        _download(url, file, session, segments, chunk_size, checksum, progress, pbar, limiter)
+        return file
+    finally:
+        if own_session:
+            session.close()
+
+
+def _is_current(session: requests.Session, url: str, file: Path, etag: str | None) -> bool:
+    """
+    Check whether an existing file still matches the remote one by size, and by ETag if it was recorded
+    """
+    r = session.head(url, headers=HEADERS, allow_redirects=True)
+    r.raise_for_status()
+    if 'content-length' in r.headers and int(r.headers['content-length']) != file.stat().st_size:
+        return False
+    return not etag or r.headers.get('etag') in (None, etag)
+
+
+def download_many(urls_to_paths: dict[str, str | Path], concurrency: int = 8, max_bandwidth: float | None = None,
+                  session: requests.Session | None = None, progress: bool = True, segments: int = 1,
+                  chunk_size: int = 1024 * 1024, check_remote: bool = False,
+                  manifest: str | Path | None = None) -> dict[str, Path]:
+    """
+    Download many files concurrently over one pooled session, with an aggregate progress bar.
+
+    Existing files are skipped (download_file only creates them once complete). With check_remote,
+    existing files are re-downloaded if their ETag (recorded in the manifest) or size changed.
+
+    :param urls_to_paths: Dict of url to destination path
+    :param concurrency: Number of files downloaded at the same time
+    :param max_bandwidth: Total bandwidth limit in bytes per second, None for unlimited
+    :param session: Session to use, e.g. one configured with request_utils.setup_proxy (its connection
+        pool should be at least concurrency * segments to be fully reused)
+    :param progress: Whether to show the aggregate progress bar
+    :param segments: Number of parallel range requests per large file
+    :param chunk_size: Read size in bytes
+    :param check_remote: Whether to check existing files against the server
+    :param manifest: Json file recording the ETag of each downloaded file
+    :return: Dict of url to path for the files that are now present (failures are logged)
+    """
+    manifest = Path(manifest) if manifest else None
+    etags = json.loads(manifest.read_text()) if manifest and manifest.is_file() else {}
+    limiter = RateLimiter(max_bandwidth) if max_bandwidth else None
+
+    own_session = session is None
+    if own_session:
+        session = _new_session(concurrency * segments)
+    pbar = tqdm.tqdm(desc='Downloading', unit=' MB', position=0, leave=True,
+                     bar_format='{desc} {n:.1f}{unit} {rate_noinv_fmt}{postfix}') if progress else None
+
+    def task(url: str, file: Path) -> Path:
+        if file.is_file():
+            if not check_remote or _is_current(session, url, file, etags.get(str(file))):
+                return file
+            file.unlink()
+        etags[str(file)] = _download(url, file, session, segments, chunk_size, None, False, pbar, limiter)
+        return file
+
+    results = {}
+    try:
+        with ThreadPoolExecutor(concurrency) as pool:
+            futures = {pool.submit(task, url, Path(file)): url for url, file in urls_to_paths.items()}
+            for fut in as_completed(futures):
+                url = futures[fut]
+                try:
+                    results[url] = fut.result()
+                except Exception as e:
+                    log.error(f'Failed to download {url}: {e}')
+                if pbar is not None:
+                    pbar.set_postfix_str(f'{len(results)}/{len(futures)} files')
+    finally:
+        if pbar is not None:
+            pbar.close()
+        if own_session:
+            session.close()
+        if manifest:
+            manifest.parent.mkdir(parents=True, exist_ok=True)
+            manifest.write_text(json.dumps(etags))
+    return results
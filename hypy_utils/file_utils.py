@@ -1,4 +1,9 @@
+from __future__ import annotations
+
 import base64
+import itertools
+import re
+from typing import Iterable
 
 FILENAME_BLACKLIST = [
     # Unix and Windows
@@ -14,24 +19,127 @@ FILENAME_BLACKLIST = [
     "~"
 ]
 
-FILENAME_REPLACE = {c: f"%{base64.b64encode(c.encode()).decode().replace('=', '')}" for c in FILENAME_BLACKLIST}
+
+def _code(s: str) -> str:
+    return f"%{base64.b64encode(s.encode()).decode().replace('=', '')}"
+
+
+FILENAME_REPLACE = {c: _code(c) for c in FILENAME_BLACKLIST}
+
+# Device names are only reserved as a whole name (optionally with an extension), in any case
+RESERVED_NAMES = {c for c in FILENAME_BLACKLIST if len(c) > 1}
+_reserved_re = re.compile('^(' + '|'.join(sorted(RESERVED_NAMES)) + r')(?=\.|$)', re.IGNORECASE | re.MULTILINE)
+# Single characters to escape, "%" first so that the "%" of the codes isn't escaped again
+_escape_chars = [('%', '%%')] + [(c, r) for c, r in FILENAME_REPLACE.items() if len(c) == 1]
+
+_unescape_codes = {r[1:]: c for c, r in FILENAME_REPLACE.items() if len(c) == 1}
+_unescape_codes.update({_code(v)[1:]: v for n in RESERVED_NAMES
+                        for v in map(''.join, itertools.product(*({c.lower(), c.upper()} for c in n)))})
+_unescape_chars = [(r, c) for c, r in FILENAME_REPLACE.items() if len(c) == 1]
+# Longest codes first, so that a code is never matched by a shorter prefix
+_unescape_re = re.compile('%(%|' + '|'.join(map(re.escape, sorted(_unescape_codes, key=len, reverse=True))) + ')')
+
+
+def _escape_chars_in(s: str) -> str:
+    # str.replace runs in C, and most names only contain a few of the characters
+    for c, r in _escape_chars:
+        if c in s:
+            s = s.replace(c, r)
+    return s
+
+
+def _unescape_code(m: re.Match) -> str:
+    return '%' if m[1] == '%' else _unescape_codes[m[1]]
 
 
 def escape_filename(fn: str) -> str:
-    fn = fn.replace("%", "[ PeRcEnT EsCaPe owo ]")
+    """
+    Escape a string into a safe file name, reversible with unescape_filename
 
-    for c, r in FILENAME_REPLACE.items():
-        fn = fn.replace(c, r)
+    Blacklisted characters are replaced by "%" and their base64 code, "%" by "%%", and reserved
+    device names (e.g. "CON" or "com1.txt") by the code of the whole name.
 
-    fn = fn.replace("[ PeRcEnT EsCaPe owo ]", "%%")
-    return fn
+    :param fn: Any string
+    :return: File name
+    """
+    stem = fn.partition('.')[0]
+    if 3 <= len(stem) <= 4 and stem.upper() in RESERVED_NAMES:
+        return _code(stem) + _escape_chars_in(fn[len(stem):])
+    return _escape_chars_in(fn)
 
 
 def unescape_filename(fn: str) -> str:
-    fn = fn.replace("%%", "[ PeRcEnT EsCaPe owo ]")
+    """
+    Restore the string of a file name escaped by escape_filename (or by older versions, which also
+    escaped device names inside other names)
+    """
+    if '%' not in fn:
+        return fn
+    if '%%' not in fn:
+        # Without escaped "%", every "%" starts a code and no code is a prefix of another, so the
+        # character codes can be replaced directly
+        for r, c in _unescape_chars:
+            if r in fn:
+                fn = fn.replace(r, c)
+        if '%' not in fn:
+            return fn
+    return _unescape_re.sub(_unescape_code, fn)
+
+
+def escape_filenames(fns: Iterable[str]) -> list[str]:
+    """
+    Escape many strings into file names, see escape_filename
+
+    Names are escaped together as one newline-joined string when none of them contain a newline.
+    """
+    fns = list(fns)
+    joined = '\n'.join(fns)
+    if joined.count('\n') != max(len(fns) - 1, 0):
+        return [escape_filename(fn) for fn in fns]
+    joined = _reserved_re.sub(lambda m: _code(m[1]), _escape_chars_in(joined))
+    return joined.split('\n') if fns else []
+
+
+def unescape_filenames(fns: Iterable[str]) -> list[str]:
+    """
+    Restore many escaped file names, see unescape_filename
+    """
+    fns = list(fns)
+    joined = '\n'.join(fns)
+    if joined.count('\n') != max(len(fns) - 1, 0):
+        return [unescape_filename(fn) for fn in fns]
+    return unescape_filename(joined).split('\n') if fns else []
+
+
+if __name__ == '__main__':
+    from hypy_utils import run_time
+
+    def legacy_escape_filename(fn: str) -> str:
+        fn = fn.replace("%", "[ PeRcEnT EsCaPe owo ]")
+        for c, r in FILENAME_REPLACE.items():
+            fn = fn.replace(c, r)
+        return fn.replace("[ PeRcEnT EsCaPe owo ]", "%%")
 
-    for c, r in FILENAME_REPLACE.items():
-        fn = fn.replace(r, c)
+    keys = [f'bucket/{i % 97}/object:{i}?v=2*{"~" * (i % 3)}.json' for i in range(100000)]
+    escaped = escape_filenames(keys)
+    assert unescape_filenames(escaped) == keys
 
-    fn = fn.replace("[ PeRcEnT EsCaPe owo ]", "%")
-    return fn
+    def legacy_escape(): return [legacy_escape_filename(k) for k in keys]
+    def single_escape(): return [escape_filename(k) for k in keys]
+    def batch_escape(): return escape_filenames(keys)
+    def legacy_unescape():
+        out = []
+        for k in escaped:
+            k = k.replace("%%", "[ PeRcEnT EsCaPe owo ]")
+            for c, r in FILENAME_REPLACE.items():
+                k = k.replace(r, c)
+            out.append(k.replace("[ PeRcEnT EsCaPe owo ]", "%"))
+        return out
+    def single_unescape(): return [unescape_filename(k) for k in escaped]
+    def batch_unescape(): return unescape_filenames(escaped)
+    run_time(legacy_escape, iter=3)
+    run_time(single_escape, iter=3)
+    run_time(batch_escape, iter=3)
+    run_time(legacy_unescape, iter=3)
+    run_time(single_unescape, iter=3)
+    run_time(batch_unescape, iter=3)
@@ -1,11 +1,26 @@
+from __future__ import annotations
+
 import datetime
-import shlex
+import functools
+import hashlib
+import json
+import os
+import subprocess
+from array import array
+from dataclasses import dataclass
 from pathlib import Path
-from subprocess import check_output
-from typing import NamedTuple
+from typing import Any, Iterable, Iterator, NamedTuple
 
 import dateutil.parser
 
+# Commits in the raw log are separated by this byte, and their fields by NUL
+RECORD_SEP = b'\x1e'
+LOG_FORMAT = '%x1e%H%x00%aN%x00%aE%x00%aI%x00%s%x00'
+# Merge the cache segments into one once there are more than this many
+MAX_CACHE_SEGMENTS = 16
+# Caches written with a different version are rebuilt
+CACHE_VERSION = 2
+
 
 class ExtractedCommit(NamedTuple):
     sha: str
@@ -19,27 +34,374 @@ class ExtractedCommit(NamedTuple):
         return dateutil.parser.isoparse(self.time)
 
 
-def git_log(path: Path, fail_silently: bool = False) -> list[ExtractedCommit]:
+def _git(path: Path, *args: str) -> list[str]:
+    return ['git', '-c', 'diff.renamelimit=0', '-c', 'diff.renames=0', '-C', str(path.absolute()), *args]
+
+
+def _parse_commit(record: bytes) -> ExtractedCommit:
+    # sha, author, email, date, subject, then "status\0path" pairs (the first status has a leading newline)
+    fields = record.decode('utf-8', 'ignore').split('\0')
+    sha, author, email, date, message = fields[:5]
+    changes = fields[5:]
+    if changes and changes[0].startswith('\n'):
+        changes[0] = changes[0][1:]
+    changes = [f for f in changes if f]
+    files = [f'{status}/{name}' for status, name in zip(changes[::2], changes[1::2])]
+    return ExtractedCommit(sha, author, email, date, message, files)
+
+
+def iter_git_log(path: Path, fail_silently: bool = False, rev: str = 'HEAD',
+                 chunk_size: int = 1 << 20) -> Iterator[ExtractedCommit]:
     """
-    Call and parse git log. This function requires that git>=2.37.1 is installed on your system.
+    Stream and parse git log, newest commit first.
+
+    The output is parsed incrementally from the pipe in NUL-delimited form, so memory usage does not
+    depend on the size of the history and file names with newlines or tabs are handled correctly.
 
     :param path: Path of git repository
-    :param fail_silently: If true, ignore errors. If false, raise exception when errors occur.
-    :return: List of commits
+    :param fail_silently: If true, skip commits that fail to parse. If false, raise exception when errors occur.
+    :param rev: Revision range to log, e.g. "abc123..HEAD" for only the commits after abc123
+    :param chunk_size: Number of bytes to read from git at a time
+    :return: Iterator of commits
     """
-    # check_call(shlex.split('git config diff.renames 0'))
-    cmd = f"git -c 'diff.renamelimit=0' -c 'diff.renames=0' -C '{path.absolute()}' log --name-status --diff-filter=AMD --pretty=format:'START_COMMIT_QwQ %H%n%aN%n%aE%n%aI%n%s%n'"
-    log = check_output(shlex.split(cmd)).decode('utf-8', 'ignore')
+    cmd = _git(path, 'log', '-z', '--name-status', '--diff-filter=AMD', f'--pretty=format:{LOG_FORMAT}', rev, '--')
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
 
-    def extract_commit(block: str) -> ExtractedCommit:
+    def extract_commit(record: bytes) -> ExtractedCommit | None:
         try:
-            lines = block.split('\n')
-            sha, author, email, date, message = lines + [""] if len(lines) == 4 else lines[:5]
-            files = [f.replace('\t', '/') for f in lines[6:]]
-            return ExtractedCommit(sha, author, email, date, message, files)
+            return _parse_commit(record)
         except Exception as e:
-            print(f'========== Commit Extract Error {e} ==========\n{block}\n==========')
+            print(f'========== Commit Extract Error {e} ==========\n{record}\n==========')
             if not fail_silently:
                 raise e
 
-    return [extract_commit(c.strip()) for c in log.split('START_COMMIT_QwQ') if c]
+    try:
+        tail = b''
+        while chunk := proc.stdout.read(chunk_size):
+            records = (tail + chunk).split(RECORD_SEP)
+            tail = records.pop()
+            for r in records:
+                if r and (c := extract_commit(r)):
+                    yield c
+        if tail and (c := extract_commit(tail)):
+            yield c
+    finally:
+        # Stop git if the caller didn't consume the whole log
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        code = proc.wait()
+
+    if code != 0:
+        raise subprocess.CalledProcessError(code, cmd)
+
+
+class GitLogCache:
+    """
+    On-disk cache of the parsed log of one repository, so that only new commits are read from git.
+
+    The cache is a list of .jsonl.zst segments, each holding the commits added since the previous
+    one. Commits that git log doesn't list (merges and commits without A/M/D changes) are stored as
+    [sha] stubs. git log orders commits by date across branches, so the commits of a merged branch
+    can belong between cached ones: the output order is taken from git rev-list, which only lists
+    shas and is cheap, and the cached commits are matched to it by sha. If HEAD no longer contains
+    the cached head (e.g. after a rebase), the cache is rebuilt.
+    """
+    def __init__(self, path: Path, cache_dir: str | Path):
+        self.path = Path(path)
+        key = hashlib.sha1(str(self.path.resolve()).encode()).hexdigest()[:16]
+        self.dir = Path(cache_dir)
+        self.meta_path = self.dir / f'{key}.json'
+        self.key = key
+        self.meta = json.loads(self.meta_path.read_text()) if self.meta_path.is_file() else None
+
+    def _segment(self, i: int) -> Path:
+        return self.dir / f'{self.key}.{i}.jsonl.zst'
+
+    def _save_meta(self, head: str, segments: int):
+        self.meta = {'repo': str(self.path.resolve()), 'head': head, 'segments': segments, 'version': CACHE_VERSION}
+        tmp = self.meta_path.with_name(self.meta_path.name + '.tmp')
+        tmp.write_text(json.dumps(self.meta))
+        os.replace(tmp, self.meta_path)
+
+    def _rev_list(self, rev: str) -> list[str]:
+        return subprocess.check_output(_git(self.path, 'rev-list', rev, '--')).decode().split()
+
+    def _iter_cached(self, segments: int) -> Iterator[list]:
+        from .zstd_utils import iter_jsonl_zst
+        for i in reversed(range(segments)):
+            yield from iter_jsonl_zst(self._segment(i))
+
+    def _is_valid(self, head: str) -> bool:
+        if self.meta is None or self.meta.get('version') != CACHE_VERSION or \
+                not all(self._segment(i).is_file() for i in range(self.meta['segments'])):
+            return False
+        return self.meta['head'] == head or subprocess.run(
+            _git(self.path, 'merge-base', '--is-ancestor', self.meta['head'], head),
+            stderr=subprocess.DEVNULL).returncode == 0
+
+    def _add_segment(self, rev: str, head: str, segment: int, fail_silently: bool) -> Iterator[ExtractedCommit]:
+        """
+        Log rev into a new segment, yielding the commits as they are parsed. The segment is only
+        added to the cache once git log completed.
+        """
+        from .zstd_utils import JsonlZstWriter
+        # git log walks the commits in the same order as rev-list, so the stubs can be written in place
+        order = iter(self._rev_list(rev))
+        tmp = self.dir / f'{self.key}.new.jsonl.zst'
+        with JsonlZstWriter(tmp) as w:
+            for c in iter_git_log(self.path, fail_silently, rev):
+                for sha in order:
+                    if sha == c.sha:
+                        break
+                    w.write([sha])
+                w.write(list(c))
+                yield c
+            w.write_all([sha] for sha in order)
+        os.replace(tmp, self._segment(segment))
+        self._save_meta(head, segment + 1)
+
+    def _in_order(self, order: list[str], fail_silently: bool) -> Iterator[ExtractedCommit]:
+        """
+        Yield the cached commits in the given order, holding only the commits read ahead of it
+        """
+        records, pending = self._iter_cached(self.meta['segments']), {}
+        for sha in order:
+            while sha not in pending and (r := next(records, None)) is not None:
+                pending[r[0]] = r
+            r = pending.pop(sha, None)
+            if r is None:
+                if not fail_silently:
+                    raise KeyError(f'Commit {sha} is missing from the git log cache {self.meta_path}')
+            elif len(r) > 1:
+                yield ExtractedCommit(*r)
+
+    def _compact(self):
+        from .zstd_utils import JsonlZstWriter
+        tmp = self.dir / f'{self.key}.compact.jsonl.zst'
+        with JsonlZstWriter(tmp) as w:
+            w.write_all(self._iter_cached(self.meta['segments']))
+        os.replace(tmp, self._segment(0))
+        for i in range(1, self.meta['segments']):
+            self._segment(i).unlink()
+        self._save_meta(self.meta['head'], 1)
+
+    def iter_log(self, fail_silently: bool = False) -> Iterator[ExtractedCommit]:
+        """
+        Iterate over the log, newest commit first, reading only commits newer than the cache from git.
+        """
+        head = subprocess.check_output(_git(self.path, 'rev-parse', 'HEAD')).decode().strip()
+        if not self._is_valid(head):
+            # Stream the full log to the caller while building the cache
+            yield from self._add_segment(head, head, 0, fail_silently)
+            return
+
+        if self.meta['head'] != head:
+            for _ in self._add_segment(f"{self.meta['head']}..{head}", head, self.meta['segments'], fail_silently):
+                pass
+        yield from self._in_order(self._rev_list(head), fail_silently)
+
+        if self.meta['segments'] > MAX_CACHE_SEGMENTS:
+            self._compact()
+
+
+def git_log(path: Path, fail_silently: bool = False, cache_dir: str | Path | None = None) -> list[ExtractedCommit]:
+    """
+    Call and parse git log. This function requires that git>=2.37.1 is installed on your system.
+
+    :param path: Path of git repository
+    :param fail_silently: If true, ignore errors. If false, raise exception when errors occur.
+    :param cache_dir: Directory to cache parsed commits in (requires zstd_utils), so that later calls
+        only read the commits added since. None to disable caching.
+    :return: List of commits
+    """
+    if cache_dir is None:
+        return list(iter_git_log(path, fail_silently))
+    return list(GitLogCache(path, cache_dir).iter_log(fail_silently))
+
+
+class _Interner:
+    def __init__(self):
+        self.ids: dict = {}
+        self.values: list = []
+
+    def __call__(self, value) -> int:
+        i = self.ids.get(value)
+        if i is None:
+            i = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return i
+
+
+@dataclass
+class CommitTable:
+    """
+    Columnar commit history of one or more repositories (requires numpy).
+
+    Each commit is a row in the per-commit arrays; authors, paths and repositories are interned into
+    tables and referenced by index. The changed files of commit i are
+    file_path[file_offsets[i]:file_offsets[i + 1]] with the matching file_status (A, M or D).
+    """
+    repos: list[str]
+    author_names: list[str]
+    author_emails: list[str]
+    paths: list[str]
+    repo: Any  # int32 index into repos
+    sha: Any  # S40 hex sha
+    author: Any  # int32 index into author_names / author_emails
+    time: Any  # int64 unix seconds (UTC)
+    tz: Any  # int16 author timezone offset in minutes
+    message: list[str]
+    file_offsets: Any  # int64, one more than the number of commits
+    file_path: Any  # int32 index into paths
+    file_status: Any  # S1
+
+    def __len__(self):
+        return len(self.sha)
+
+    @classmethod
+    def from_commits(cls, commits: Iterable[ExtractedCommit], repo: str) -> CommitTable:
+        """
+        Build the table of one repository from parsed commits
+        """
+        import numpy as np
+        from .serializer import parse_date_times64
+
+        authors, paths = _Interner(), _Interner()
+        shas, times, messages = [], [], []
+        author, tz = array('i'), array('h')
+        offsets, file_path, status = array('q', [0]), array('i'), bytearray()
+        for c in commits:
+            shas.append(c.sha)
+            author.append(authors((c.author, c.email)))
+            times.append(c.time)
+            # %aI always ends with the +HH:MM offset
+            tz.append((-1 if c.time[-6] == '-' else 1) * (int(c.time[-5:-3]) * 60 + int(c.time[-2:])))
+            messages.append(c.message)
+            for f in c.file_names:
+                st, name = f.split('/', 1)
+                status += st.encode()[:1]
+                file_path.append(paths(name))
+            offsets.append(len(file_path))
+
+        return cls(
+            repos=[repo],
+            author_names=[a[0] for a in authors.values],
+            author_emails=[a[1] for a in authors.values],
+            paths=paths.values,
+            repo=np.zeros(len(shas), np.int32),
+            sha=np.array(shas, 'S40'),
+            author=np.frombuffer(author, np.int32).copy(),
+            time=parse_date_times64(times).astype(np.int64) if times else np.zeros(0, np.int64),
+            tz=np.frombuffer(tz, np.int16).copy(),
+            message=messages,
+            file_offsets=np.frombuffer(offsets, np.int64).copy(),
+            file_path=np.frombuffer(file_path, np.int32).copy(),
+            file_status=np.frombuffer(bytes(status), 'S1').copy(),
+        )
+
+    @classmethod
+    def concat(cls, tables: Iterable[CommitTable]) -> CommitTable:
+        """
+        Concatenate tables, merging their author, path and repository tables
+        """
+        import numpy as np
+
+        tables = list(tables)
+        repos, authors, paths = _Interner(), _Interner(), _Interner()
+
+        def remap(intern: _Interner, values: Iterable, ids: Any) -> Any:
+            return np.array([intern(v) for v in values], np.int32)[ids] if len(ids) else ids.astype(np.int32)
+
+        def cat(arrays: list, dtype: str) -> Any:
+            return np.concatenate(arrays + [np.zeros(0, dtype)])
+
+        repo = cat([remap(repos, t.repos, t.repo) for t in tables], 'int32')
+        author = cat([remap(authors, zip(t.author_names, t.author_emails), t.author) for t in tables], 'int32')
+        file_path = cat([remap(paths, t.paths, t.file_path) for t in tables], 'int32')
+
+        offsets, base = [np.zeros(1, np.int64)], 0
+        for t in tables:
+            offsets.append(t.file_offsets[1:] + base)
+            base += t.file_offsets[-1]
+
+        return cls(
+            repos=repos.values,
+            author_names=[a[0] for a in authors.values],
+            author_emails=[a[1] for a in authors.values],
+            paths=paths.values,
+            repo=repo,
+            sha=cat([t.sha for t in tables], 'S40'),
+            author=author,
+            time=cat([t.time for t in tables], 'int64'),
+            tz=cat([t.tz for t in tables], 'int16'),
+            message=[m for t in tables for m in t.message],
+            file_offsets=np.concatenate(offsets),
+            file_path=file_path,
+            file_status=cat([t.file_status for t in tables], 'S1'),
+        )
+
+    def commit(self, i: int) -> ExtractedCommit:
+        """
+        Convert row i back into an ExtractedCommit
+        """
+        a = int(self.author[i])
+        tz = datetime.timezone(datetime.timedelta(minutes=int(self.tz[i])))
+        time = datetime.datetime.fromtimestamp(int(self.time[i]), tz).isoformat()
+        lo, hi = self.file_offsets[i], self.file_offsets[i + 1]
+        files = [f'{st.decode()}/{self.paths[p]}' for st, p in zip(self.file_status[lo:hi], self.file_path[lo:hi])]
+        return ExtractedCommit(self.sha[i].decode(), self.author_names[a], self.author_emails[a], time,
+                               self.message[i], files)
+
+    def datetimes(self) -> Any:
+        """
+        :return: Commit times as a numpy datetime64[s] array (UTC)
+        """
+        return self.time.astype('datetime64[s]')
+
+    def save(self, file_path: str | Path):
+        """
+        Save to a .pkl.zst file (requires zstd_utils)
+        """
+        from .zstd_utils import write_pickle_zst
+        write_pickle_zst(file_path, vars(self))
+
+    @classmethod
+    def load(cls, file_path: str | Path) -> CommitTable:
+        from .zstd_utils import load_pickle_zst
+        return cls(**load_pickle_zst(file_path))
+
+
+def _extract_repo(path: str | Path, fail_silently: bool, cache_dir: str | Path | None) -> CommitTable | None:
+    try:
+        commits = GitLogCache(Path(path), cache_dir).iter_log(fail_silently) if cache_dir is not None \
+            else iter_git_log(Path(path), fail_silently)
+        return CommitTable.from_commits(commits, str(path))
+    except Exception as e:
+        print(f'========== Repo Extract Error {e} ==========\n{path}\n==========')
+        if not fail_silently:
+            raise e
+
+
+def git_log_many(paths: Iterable[str | Path], max_workers: int | None = None, processes: bool = True,
+                 fail_silently: bool = False, cache_dir: str | Path | None = None, **kwargs) -> CommitTable:
+    """
+    Extract the history of many repositories concurrently into one CommitTable (requires numpy and tqdm).
+
+    Each worker runs git log for one repository at a time and parses it into a per-repository table,
+    so only the compact columnar results are sent back and merged.
+
+    :param paths: Paths of git repositories
+    :param max_workers: Number of repositories processed at the same time (defaults to the number of cpus)
+    :param processes: Parse in worker processes (True) or threads (False)
+    :param fail_silently: If true, skip repositories and commits that fail. If false, raise the first error.
+    :param cache_dir: Directory for the per-repository GitLogCache, None to disable caching
+    :param kwargs: Extra arguments for tqdm
+    :return: Table of all commits, grouped by repository
+    """
+    from .tqdm_utils import imap
+
+    fn = functools.partial(_extract_repo, fail_silently=fail_silently, cache_dir=cache_dir)
+    kwargs.setdefault('desc', 'Extracting repos')
+    tables = imap(fn, paths, ordered=False, processes=processes, max_workers=max_workers, chunksize=1, **kwargs)
+    return CommitTable.concat(t for t in tables if t is not None)
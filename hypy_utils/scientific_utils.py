@@ -64,6 +64,42 @@ def calc_col_stats(col: np.ndarray | list) -> Statistics:
     return Statistics(*_calc_col_stats_helper(col))
 
 
+@njit(cache=True)
+def _parse_iso_helper(mat: np.ndarray) -> np.ndarray:
+    """
+    Parse ISO-8601 date times from a (n, width) uint8 matrix of ascii bytes (zero padded) into
+    int64 unix seconds. See serializer.parse_date_times64.
+    """
+    out = np.empty(mat.shape[0], dtype=np.int64)
+    for r in range(mat.shape[0]):
+        row = mat[r]
+        n = 0
+        while n < row.shape[0] and row[n] != 0:
+            n += 1
+
+        y = (row[0] - 48) * 1000 + (row[1] - 48) * 100 + (row[2] - 48) * 10 + row[3] - 48
+        m = (row[5] - 48) * 10 + row[6] - 48
+        d = (row[8] - 48) * 10 + row[9] - 48
+        secs = 0
+        if n >= 19:
+            secs = ((row[11] - 48) * 10 + row[12] - 48) * 3600 + ((row[14] - 48) * 10 + row[15] - 48) * 60 + \
+                   (row[17] - 48) * 10 + row[18] - 48
+
+            # ±HH:MM offset at the end of the string
+            if n > 19 and row[n - 3] == 58 and (row[n - 6] == 43 or row[n - 6] == 45):
+                off = ((row[n - 5] - 48) * 10 + row[n - 4] - 48) * 3600 + ((row[n - 2] - 48) * 10 + row[n - 1] - 48) * 60
+                secs -= off if row[n - 6] == 43 else -off
+
+        # Days since epoch from the civil date (Howard Hinnant's algorithm)
+        y -= m <= 2
+        era = (y if y >= 0 else y - 399) // 400
+        yoe = y - era * 400
+        doy = (153 * (m + (-3 if m > 2 else 9)) + 2) // 5 + d - 1
+        doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+        out[r] = (era * 146097 + doe - 719468) * 86400 + secs
+    return out
+
+
 def plot(**kwargs) -> plt:
     """
     Pyplot configurator shorthand
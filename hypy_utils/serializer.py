@@ -7,11 +7,21 @@ import hashlib
 import inspect
 import io
 import json
+import itertools
 import pickle
+import re
+import sys
+import threading
+from collections.abc import Iterator
 from enum import Enum
 from pathlib import Path
 from types import SimpleNamespace
-from typing import Any
+from typing import Any, BinaryIO, Callable, Iterable
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 def pickle_encode(obj: Any, protocol=None, fix_imports=True) -> bytes:
@@ -73,13 +83,97 @@ def infer(o: object) -> object | None:
     return None
 
 
+# Per-type conversion functions, compiled on first sight of a type (None = not supported)
+_encoders: dict[type, Callable[[Any], Any]] = {}
+_plans: dict[type, Callable[[Any], Any] | None] = {}
+_forced_plans: dict[type, Callable[[Any], Any] | None] = {}
+
+
+def register_encoder(cls: type, fn: Callable[[Any], Any]):
+    """
+    Register a custom JSON conversion for a type (and its subclasses)
+
+    >>> register_encoder(complex, lambda c: [c.real, c.imag])
+    >>> json_stringify(1 + 2j)
+    '[1.0, 2.0]'
+
+    :param cls: Type to convert
+    :param fn: Function converting an instance into something json serializable
+    """
+    _encoders[cls] = fn
+    # Subclasses might have been compiled with a different plan
+    _plans.clear()
+    _forced_plans.clear()
+
+
+def _compile_encoder(t: type, forced: bool) -> Callable[[Any], Any] | None:
+    """
+    Build the conversion function for a type, following the same rules as infer() (and the
+    forced __dict__ fallback of ForceJSONEcoder)
+    """
+    for base in t.__mro__:
+        if base in _encoders:
+            return _encoders[base]
+
+    # Dataclasses are converted shallowly, the encoder recurses into the fields itself
+    if dataclasses.is_dataclass(t):
+        names = tuple(f.name for f in dataclasses.fields(t))
+        return lambda o: {n: getattr(o, n) for n in names}
+    if issubclass(t, SimpleNamespace):
+        return vars
+    if issubclass(t, (datetime.datetime, datetime.date)):
+        return t.isoformat
+    if issubclass(t, (set, frozenset)):
+        return list
+    if issubclass(t, Path):
+        return str
+    if issubclass(t, bytes):
+        return lambda o: base64.b64encode(o).decode()
+    if issubclass(t, Enum):
+        return lambda o: o.name
+
+    # Classes themselves (instances of a metaclass) aren't converted
+    if not forced or issubclass(t, type):
+        return None
+
+    # Support for custom classes (get dict values, plus slot values for classes with __slots__)
+    slots = tuple(n for c in t.__mro__ for n in _slot_names(c) if n not in ('__dict__', '__weakref__'))
+    if slots:
+        return lambda o: {**{n: getattr(o, n) for n in slots if hasattr(o, n)}, **getattr(o, '__dict__', {})}
+    if t.__dictoffset__:
+        return lambda o: dict(vars(o))
+    return None
+
+
+def _slot_names(cls: type) -> tuple[str, ...]:
+    slots = cls.__dict__.get('__slots__', ())
+    return (slots,) if isinstance(slots, str) else tuple(slots)
+
+
+def type_encoder(t: type, forced: bool = False) -> Callable[[Any], Any] | None:
+    """
+    Get the cached conversion function for a type
+
+    :param t: Type of the object to encode
+    :param forced: Whether to fall back to the object's __dict__ / __slots__
+    :return: Conversion function, or None if the type isn't supported
+    """
+    plans = _forced_plans if forced else _plans
+    try:
+        return plans[t]
+    except KeyError:
+        fn = plans[t] = _compile_encoder(t, forced)
+        return fn
+
+
 class EnhancedJSONEncoder(json.JSONEncoder):
     """
     An improvement to the json.JSONEncoder class, which supports:
     encoding for dataclasses, encoding for datetime, and sets
     """
     def default(self, o: object) -> object:
-        return infer(o) or super().default(o)
+        fn = type_encoder(type(o))
+        return fn(o) if fn else super().default(o)
 
 
 class ForceJSONEcoder(EnhancedJSONEncoder):
@@ -87,33 +181,86 @@ class ForceJSONEcoder(EnhancedJSONEncoder):
     A json encoder that can serialize almost everything (including custom classes, byte arrays)
     """
     def default(self, o: object) -> object:
-        infer_result = infer(o)
-        if infer_result:
-            return infer_result
+        fn = type_encoder(type(o), forced=True)
+        return fn(o) if fn else super().default(o)
 
-        # # Support EnumType
-        # if isinstance(o, EnumType):
-        #     return {i.name: i.value for i in o}
 
-        # Support for custom classes (get dict values)
-        if hasattr(o, '__dict__') and not inspect.isclass(o):
-            return dict(vars(o))
+def _orjson_default(o: object) -> object:
+    fn = type_encoder(type(o))
+    if fn:
+        return fn(o)
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
 
-        return super().default(o)
+
+def _orjson_default_forced(o: object) -> object:
+    fn = type_encoder(type(o), forced=True)
+    if fn:
+        return fn(o)
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+
+def _orjson_option(args: dict) -> int | None:
+    """
+    Translate json.dumps arguments to orjson options
+
+    :return: orjson option flags, or None if orjson can't reproduce the stdlib output for these arguments
+    """
+    if orjson is None or args.get('ensure_ascii') or not set(args) <= {'ensure_ascii', 'indent', 'separators', 'sort_keys'}:
+        return None
+
+    # Dataclasses and datetimes go through our own encoders to match the stdlib output
+    opt = orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    indent, seps = args.get('indent'), args.get('separators')
+    if indent in (2, '  ') and seps in (None, (',', ': ')):
+        opt |= orjson.OPT_INDENT_2
+    elif indent is not None or tuple(seps or ()) != (',', ':'):
+        # orjson only writes compact output, while the stdlib default separators have spaces
+        return None
+
+    if args.get('sort_keys'):
+        opt |= orjson.OPT_SORT_KEYS
+    return opt
+
+
+def _orjson_dumps(obj: object, forced: bool, kwargs: dict) -> bytes | None:
+    """
+    Serialize with orjson if it's installed and compatible with the arguments
+
+    :return: utf-8 json bytes, or None if the stdlib encoder should be used instead
+    """
+    opt = _orjson_option({'ensure_ascii': False, **kwargs})
+    if opt is None:
+        return None
+    try:
+        return orjson.dumps(obj, default=_orjson_default_forced if forced else _orjson_default, option=opt)
+    except orjson.JSONEncodeError:
+        # E.g. integers over 64 bits or very deep nesting, let the stdlib encoder handle (or report) it
+        return None
 
 
-def json_stringify(obj: object, forced: bool = True, **kwargs) -> str:
+def json_stringify(obj: object, forced: bool = True, fast: bool = False, **kwargs) -> str:
     """
     Serialize json string with support for dataclasses and datetime and sets and with custom
     configuration.
 
+    With fast=True and orjson installed, orjson is used for the options it supports (indent=2, or
+    compact separators=(',', ':'), with optional sort_keys). Its output is not identical to the stdlib
+    encoder: Enum members are written as their value, NaN/Infinity are written as null, floats use
+    orjson's exponent format (1e16 instead of 1e+16), non-str dict keys are converted instead of
+    rejected, and UUIDs are written as strings.
+
     Preconditions:
         - obj != None
 
     :param obj: Objects
     :param forced: Whether to force the conversion of classes and byte arrays
+    :param fast: Use orjson when possible, accepting the differences above
     :return: Json strings
     """
+    fast = _orjson_dumps(obj, forced, kwargs) if fast else None
+    if fast is not None:
+        return fast.decode()
+
     args = dict(ensure_ascii=False, cls=ForceJSONEcoder if forced else EnhancedJSONEncoder)
     args.update(kwargs)
     return json.dumps(obj, **args)
@@ -127,7 +274,120 @@ class SafeNamespace(SimpleNamespace):
             return None
 
 
-def jsn(s: str) -> SafeNamespace:
+def _lazy_wrap(v: Any) -> Any:
+    if isinstance(v, dict):
+        return LazyNamespace(v)
+    if isinstance(v, list):
+        return LazyList(v)
+    return v
+
+
+class LazyNamespace:
+    """
+    Read-mostly namespace view over a parsed json dict. Child dicts and lists are only wrapped when
+    they are accessed, and missing attributes return None like SafeNamespace.
+
+    Keys named like methods (e.g. to_dict) or dunders are shadowed as attributes, use ns['to_dict'].
+    """
+    __slots__ = ('_d',)
+
+    def __init__(self, d: dict):
+        object.__setattr__(self, '_d', d)
+
+    def __getattr__(self, attr: str) -> Any:
+        # _d is missing before __init__ (e.g. in copy or pickle), and protocol lookups must not return None
+        if attr == '_d' or (attr.startswith('__') and attr.endswith('__')):
+            raise AttributeError(attr)
+        return _lazy_wrap(self._d.get(attr))
+
+    def __setattr__(self, attr: str, value: Any):
+        self._d[attr] = value
+
+    def __delattr__(self, attr: str):
+        self._d.pop(attr, None)
+
+    def __getitem__(self, key: str) -> Any:
+        return _lazy_wrap(self._d[key])
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._d
+
+    def __iter__(self):
+        return iter(self._d)
+
+    def __len__(self) -> int:
+        return len(self._d)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, LazyNamespace) and self._d == other._d
+
+    def __repr__(self) -> str:
+        return f'LazyNamespace({self._d!r})'
+
+    def __reduce__(self):
+        return LazyNamespace, (self._d,)
+
+    def to_dict(self) -> dict:
+        """
+        :return: The underlying dict (not a copy)
+        """
+        return self._d
+
+
+class LazyList:
+    """
+    Sequence view over a parsed json list that wraps its elements on access
+    """
+    __slots__ = ('_l',)
+
+    def __init__(self, lst: list):
+        self._l = lst
+
+    def __getitem__(self, i: int | slice) -> Any:
+        if isinstance(i, slice):
+            return LazyList(self._l[i])
+        return _lazy_wrap(self._l[i])
+
+    def __iter__(self):
+        return map(_lazy_wrap, self._l)
+
+    def __len__(self) -> int:
+        return len(self._l)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, LazyList) and self._l == other._l
+
+    def __repr__(self) -> str:
+        return f'LazyList({self._l!r})'
+
+    def to_list(self) -> list:
+        """
+        :return: The underlying list (not a copy)
+        """
+        return self._l
+
+
+register_encoder(LazyNamespace, LazyNamespace.to_dict)
+register_encoder(LazyList, LazyList.to_list)
+
+
+def jsn(s: str | bytes, lazy: bool = False) -> SafeNamespace | LazyNamespace:
+    """
+    Parse json into namespaces, so that fields can be accessed as attributes
+
+    :param s: Json string
+    :param lazy: Return a LazyNamespace view over the plain parsed dicts instead of eagerly creating
+        a SafeNamespace for every dict, which is much faster when only a few fields are accessed.
+        The dicts are parsed with orjson if it is installed, which reads integers beyond 64 bits as
+        floats. Documents orjson rejects (e.g. with NaN or Infinity) are parsed with json instead.
+    """
+    if lazy:
+        if orjson:
+            try:
+                return _lazy_wrap(orjson.loads(s))
+            except orjson.JSONDecodeError:
+                pass
+        return _lazy_wrap(json.loads(s))
     return json.loads(s, object_hook=lambda d: SafeNamespace(**d))
 
 
@@ -177,8 +437,79 @@ def read(file: Path | str) -> str:
     return Path(file).read_text('utf-8')
 
 
-def write_json(fp: Path | str, data: Any, **kwargs):
-    write(fp, json_stringify(data, **kwargs))
+def write_json(fp: Path | str, data: Any, forced: bool = True, fast: bool = False, **kwargs):
+    """
+    Write data as json, see json_stringify for the arguments
+    """
+    fast = _orjson_dumps(data, forced, kwargs) if fast else None
+    write(fp, fast if fast is not None else json_stringify(data, forced, **kwargs))
+
+
+class _LazyList(list):
+    """
+    A list that iterates over an iterator instead of its (empty) contents, so that the stdlib
+    encoder writes iterators as json arrays without materializing them
+    """
+    def __init__(self, it: Iterator):
+        super().__init__()
+        self._it = it
+
+    def __iter__(self):
+        return iter(self._it)
+
+    def __bool__(self):
+        return True
+
+
+class _StreamingEncoderMixin:
+    def default(self, o: object) -> object:
+        if isinstance(o, Iterator):
+            # Empty iterators must be written as a real empty list, the encoder skips "[" otherwise
+            first = next(o, _LazyList)
+            return [] if first is _LazyList else _LazyList(itertools.chain((first,), o))
+        return super().default(o)
+
+
+class _StreamingEncoder(_StreamingEncoderMixin, EnhancedJSONEncoder):
+    pass
+
+
+class _ForceStreamingEncoder(_StreamingEncoderMixin, ForceJSONEcoder):
+    pass
+
+
+def dump_json(fp: Path | str | BinaryIO, obj: Any, forced: bool = True, buffer_size: int = 1 << 16, **kwargs):
+    """
+    Stream json to a file without building the whole string in memory. Generators and other
+    iterators are consumed lazily and written as json arrays, so memory usage is proportional to
+    the nesting depth rather than the output size.
+
+    :param fp: File path, or a binary file-like object (e.g. an opened file or socket.makefile('wb'))
+    :param obj: Object to serialize
+    :param forced: Whether to force the conversion of classes and byte arrays
+    :param buffer_size: Number of characters to collect before each write
+    :param kwargs: Extra arguments for the json encoder (e.g. indent)
+    """
+    args = dict(ensure_ascii=False)
+    args.update(kwargs)
+    encoder = (_ForceStreamingEncoder if forced else _StreamingEncoder)(**args)
+
+    def dump(f: BinaryIO):
+        buf, size = [], 0
+        for chunk in encoder.iterencode(obj):
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= buffer_size:
+                f.write(''.join(buf).encode())
+                buf, size = [], 0
+        f.write(''.join(buf).encode())
+
+    if isinstance(fp, (str, Path)):
+        with ensure_parent(fp).open('wb') as f:
+            dump(f)
+    else:
+        dump(fp)
+        fp.flush()
 
 
 def parse_date_time(iso: str) -> datetime.datetime:
@@ -211,6 +542,76 @@ def parse_date_only(iso: str) -> datetime.datetime:
     return datetime.datetime(int(iso[:4]), int(iso[5:7]), int(iso[8:10]))
 
 
+_iso_fraction_re = re.compile(r'\.(\d+)')
+
+
+def _iso_for_py310(iso: str) -> str:
+    """
+    Rewrite an ISO-8601 date time into the subset Python 3.10 fromisoformat accepts: no Z suffix,
+    and exactly 6 fractional digits (extra digits are truncated)
+    """
+    if iso.endswith('Z'):
+        iso = iso[:-1] + '+00:00'
+    return _iso_fraction_re.sub(lambda m: '.' + m[1][:6].ljust(6, '0'), iso, count=1)
+
+
+def parse_date_times(isos: Iterable[str]) -> list[datetime.datetime]:
+    """
+    Parse many ISO-8601 date times. Unlike parse_date_time, this supports fractional seconds and
+    Z / ±HH:MM offsets (which produce timezone-aware datetimes).
+
+    :param isos: Input dates
+    :return: Datetime objects
+    """
+    parse = datetime.datetime.fromisoformat
+    if sys.version_info < (3, 11):
+        return [parse(_iso_for_py310(s)) for s in isos]
+    return [parse(s) for s in isos]
+
+
+def parse_date_times64(isos: Iterable[str] | Any, use_numba: bool = False) -> Any:
+    """
+    Parse many ISO-8601 date times into a numpy datetime64[s] array (requires numpy, and numba if
+    use_numba is set). The numba kernel lives in scientific_utils, so use_numba also imports matplotlib.
+
+    Times with a Z / ±HH:MM offset are converted to UTC, times without an offset are kept as-is.
+    Fractional seconds are truncated. Date-only strings ("YYYY-MM-DD") are parsed as midnight.
+
+    Preconditions:
+        - isos are ascii strings starting with "YYYY-MM-DD" and optionally "THH:MM:SS"
+
+    :param isos: List or numpy array of input dates
+    :param use_numba: Parse with a compiled numba kernel instead of numpy's own date parser
+    :return: datetime64[s] array
+    """
+    import numpy as np
+
+    arr = np.asarray(isos)
+    arr = arr.astype('S') if arr.dtype.kind != 'S' else arr
+    n, width = len(arr), arr.dtype.itemsize
+    mat = np.ascontiguousarray(arr).view(np.uint8).reshape(n, width)
+
+    if use_numba:
+        from .scientific_utils import _parse_iso_helper
+        return _parse_iso_helper(mat).astype('datetime64[s]')
+
+    # numpy parses the "YYYY-MM-DDTHH:MM:SS" part itself, offsets are read from the end of the string
+    base = arr.astype('S19').astype('datetime64[s]')
+    rows = np.arange(n)
+    lens = width - (mat[:, ::-1] != 0).argmax(axis=1)
+    sign = mat[rows, np.maximum(lens - 6, 0)]
+    has_off = (lens > 19) & (mat[rows, np.maximum(lens - 3, 0)] == ord(':')) & \
+              ((sign == ord('+')) | (sign == ord('-')))
+    if not has_off.any():
+        return base
+
+    def num(i: int) -> np.ndarray:
+        return (mat[rows, (lens - i) % width].astype(np.int64) - 48) * 10 + mat[rows, (lens - i + 1) % width] - 48
+
+    off = np.where(sign == ord('-'), -1, 1) * (num(5) * 3600 + num(2) * 60)
+    return base - np.where(has_off, off, 0).astype('timedelta64[s]')
+
+
 def md5(file: Path | str) -> str:
     """
     Compute md5 of a file
@@ -218,9 +619,179 @@ def md5(file: Path | str) -> str:
     :param file: File path
     :return: md5 string
     """
-    file = Path(file)
-    hash_md5 = hashlib.md5()
-    with open(file, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    return hash_file(file, 'md5')
+
+
+_hash_buffers = threading.local()
+
+
+def _new_hash(algo: str):
+    """
+    Create a hash object for a hashlib algorithm name (e.g. md5, sha256, blake2b) or an xxhash
+    algorithm name (e.g. xxh64, xxh3_128, requires the xxhash package)
+    """
+    if algo.startswith('xxh'):
+        import xxhash
+        return getattr(xxhash, algo)()
+    return hashlib.new(algo)
+
+
+def hash_file(file: Path | str, algo: str = 'md5', buffer_size: int = 1 << 20) -> str:
+    """
+    Compute the hash of a file, reading into a reusable buffer (one per thread)
+
+    :param file: File path
+    :param algo: Hash algorithm (md5, sha1, sha256, blake2b, ..., or xxh64, xxh3_64, xxh3_128)
+    :param buffer_size: Read size in bytes
+    :return: Hex digest
+    """
+    buf = getattr(_hash_buffers, 'buf', None)
+    if buf is None or len(buf) != buffer_size:
+        buf = _hash_buffers.buf = memoryview(bytearray(buffer_size))
+
+    h = _new_hash(algo)
+    with open(file, 'rb', buffering=0) as f:
+        while n := f.readinto(buf):
+            h.update(buf[:n])
+    return h.hexdigest()
+
+
+class HashCache:
+    """
+    Cache of file hashes keyed by (path, size, mtime, inode), so unchanged files are never re-hashed.
+    The cache is persisted as json if a file path is given.
+    """
+    def __init__(self, file: Path | str | None = None):
+        self.file = Path(file) if file else None
+        self.entries: dict[str, list] = {}
+        if self.file and self.file.is_file():
+            self.entries = json.loads(read(self.file))
+
+    @staticmethod
+    def stat(path: Path | str) -> list:
+        """
+        :return: The (size, mtime, inode) a cached digest is valid for
+        """
+        st = Path(path).stat()
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    @staticmethod
+    def _key(path: Path | str, algo: str) -> str:
+        return f'{algo}:{Path(path).absolute()}'
+
+    def get(self, path: Path | str, algo: str = 'md5', before: list | None = None) -> str | None:
+        """
+        :param before: File stat if already known (see stat)
+        """
+        entry = self.entries.get(self._key(path, algo))
+        return entry[3] if entry and entry[:3] == (before or self.stat(path)) else None
+
+    def put(self, path: Path | str, digest: str, algo: str = 'md5', before: list | None = None) -> bool:
+        """
+        Cache a digest. Pass the stat taken before hashing so that a file modified while it was
+        hashed isn't cached with a digest of stale content.
+
+        :param before: File stat taken before hashing (see stat)
+        :return: Whether the digest was cached
+        """
+        after = self.stat(path)
+        if before is not None and before != after:
+            return False
+        self.entries[self._key(path, algo)] = after + [digest]
+        return True
+
+    def save(self):
+        if self.file:
+            write(self.file, json.dumps(self.entries))
+
+
+def hash_files(files: Iterable[Path | str], algo: str = 'md5', workers: int = 8,
+               cache: HashCache | None = None, buffer_size: int = 1 << 20) -> dict[Path | str, str]:
+    """
+    Hash many files concurrently (hashlib releases the GIL while hashing large buffers)
+
+    :param files: File paths
+    :param algo: Hash algorithm, see hash_file
+    :param workers: Number of threads
+    :param cache: Optional HashCache to skip unchanged files (it is saved after hashing)
+    :param buffer_size: Read size in bytes
+    :return: Dict of file path to hex digest
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def task(file: Path | str) -> str:
+        if not cache:
+            return hash_file(file, algo, buffer_size)
+        before = cache.stat(file)
+        digest = cache.get(file, algo, before)
+        if digest is None:
+            digest = hash_file(file, algo, buffer_size)
+            cache.put(file, digest, algo, before)
+        return digest
+
+    files = list(files)
+    with ThreadPoolExecutor(workers) as pool:
+        result = dict(zip(files, pool.map(task, files)))
+    if cache:
+        cache.save()
+    return result
+
+
+if __name__ == '__main__':
+    from hypy_utils import run_time
+
+    class LegacyEncoder(json.JSONEncoder):
+        def default(self, o: object) -> object:
+            r = infer(o)
+            if r:
+                return r
+            if hasattr(o, '__dict__') and not inspect.isclass(o):
+                return dict(vars(o))
+            return super().default(o)
+
+    @dataclasses.dataclass
+    class Inner:
+        path: Path
+        tags: set
+
+    @dataclasses.dataclass
+    class Row:
+        id: int
+        name: str
+        time: datetime.datetime
+        inner: Inner
+
+    now = datetime.datetime.now()
+    rows = [Row(i, f'row {i}', now, Inner(Path(f'/tmp/{i}'), {i})) for i in range(100000)]
+    assert json_stringify(rows) == json.dumps(rows, ensure_ascii=False, cls=LegacyEncoder)
+
+    def legacy_stringify(): return json.dumps(rows, ensure_ascii=False, cls=LegacyEncoder)
+    def cached_stringify(): return json_stringify(rows)
+    run_time(legacy_stringify, iter=3)
+    run_time(cached_stringify, iter=3)
+
+    doc = json.dumps({'items': [{'id': i, 'user': {'name': f'u{i}', 'meta': {'a': [1, 2, 3], 'b': None}}}
+                                for i in range(100000)]})
+    assert jsn(doc).items[5].user.name == jsn(doc, lazy=True).items[5].user.name == 'u5'
+    assert jsn(doc, lazy=True).items[5].user.missing is None
+
+    def eager_jsn(): return jsn(doc).items[5].user.name
+    def lazy_jsn(): return jsn(doc, lazy=True).items[5].user.name
+    run_time(eager_jsn, iter=3)
+    run_time(lazy_jsn, iter=3)
+
+    isos = ['2021-10-20T23:50:14', '2021-10-20T23:50:14.123456Z', '2021-10-20T23:50:14.5+02:00',
+            '2021-10-20T23:50:14-05:30', '2021-10-20']
+    expected = [d.astimezone(datetime.timezone.utc).replace(tzinfo=None) if d.tzinfo else d
+                for d in parse_date_times(isos)]
+    expected = [d.replace(microsecond=0) for d in expected]
+    assert list(parse_date_times64(isos).astype(datetime.datetime)) == expected
+    assert list(parse_date_times64(isos, use_numba=True).astype(datetime.datetime)) == expected
+
+    logs = [(now + datetime.timedelta(seconds=i)).isoformat() + 'Z' for i in range(1000000)]
+    def loop_parse_date_time(): return [parse_date_time(s) for s in logs]
+    def batch_parse_date_times64(): return parse_date_times64(logs)
+    def batch_parse_date_times64_numba(): return parse_date_times64(logs, use_numba=True)
+    run_time(loop_parse_date_time, iter=1)
+    run_time(batch_parse_date_times64, iter=1)
+    run_time(batch_parse_date_times64_numba, iter=1)
@@ -3,9 +3,14 @@ Importing this file requires installing tqdm.
 """
 from __future__ import annotations
 
+import asyncio
+import itertools
 import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from functools import partial
-from typing import Callable, Iterable
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, Iterator
 
 import tqdm
 from tqdm.contrib.concurrent import process_map, thread_map
@@ -27,6 +32,293 @@ def tmap(fn: Callable, lst: Iterable, *args, **kwargs) -> list:
     return thread_map(fn, lst, *args, **tqdm_args)
 
 
+def _apply_chunk(fn: Callable, chunk: list) -> tuple[float, list]:
+    start = time.perf_counter()
+    results = [fn(i) for i in chunk]
+    return time.perf_counter() - start, results
+
+
+def _imap(pool: Executor, fn: Callable, lst: Iterable, ordered: bool, chunksize: int | None,
+          max_in_flight: int, chunk_seconds: float, pbar: tqdm.tqdm, max_workers: int) -> Iterator:
+    it = iter(lst)
+    # Start small and grow from the measured per-item time unless the chunk size is fixed
+    size = chunksize or 1
+    # Auto-tuned chunks must leave room for every worker to have one in flight
+    max_size = max(1, max_in_flight // max_workers)
+    pending: deque[tuple[Future, int]] | dict[Future, int] = deque() if ordered else {}
+    in_flight = 0
+
+    def submit() -> bool:
+        nonlocal in_flight
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return False
+        fut = pool.submit(_apply_chunk, fn, chunk)
+        if ordered:
+            pending.append((fut, len(chunk)))
+        else:
+            pending[fut] = len(chunk)
+        in_flight += len(chunk)
+        return True
+
+    def fill():
+        while in_flight < max_in_flight and submit():
+            pass
+
+    fill()
+    while pending:
+        if ordered:
+            fut, n = pending.popleft()
+            done = [(fut, n)]
+        else:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            done = [(f, pending.pop(f)) for f in finished]
+
+        for fut, n in done:
+            elapsed, results = fut.result()
+            in_flight -= n
+            pbar.update(n)
+            if chunksize is None and elapsed > 0:
+                # Aim for chunk_seconds per chunk, growing at most 4x at a time
+                size = max(1, min(int(n * chunk_seconds / elapsed), size * 4, max_size))
+            yield from results
+        fill()
+
+
+def imap(fn: Callable, lst: Iterable, ordered: bool = True, processes: bool = True, max_workers: int | None = None,
+         chunksize: int | None = None, max_in_flight: int | None = None, chunk_seconds: float = 0.05,
+         **kwargs) -> Iterator:
+    """
+    Streaming version of pmap/tmap: results are yielded as they complete, only a bounded number of
+    items is in flight at a time, and the input can be a generator of unknown length.
+
+    :param fn: Function to map (must be picklable for processes)
+    :param lst: Input iterable
+    :param ordered: Yield results in input order (True) or as soon as their chunk completes (False)
+    :param processes: Use a process pool (True) or a thread pool (False)
+    :param max_workers: Number of workers (defaults to the number of cpus)
+    :param chunksize: Items per task, None to auto-tune it from the measured per-item time
+    :param max_in_flight: Maximum number of submitted but not yet yielded items (defaults to 1000 per worker)
+    :param chunk_seconds: Target duration of a chunk when auto-tuning
+    :param kwargs: Extra arguments for tqdm (e.g. desc, total)
+    """
+    max_workers = max_workers or os.cpu_count()
+    max_in_flight = max_in_flight or max_workers * 1000
+    tqdm_args = dict(position=0, leave=True, total=len(lst) if hasattr(lst, '__len__') else None)
+    tqdm_args.update(kwargs)
+
+    pool = ProcessPoolExecutor(max_workers) if processes else ThreadPoolExecutor(max_workers)
+    with pool, tqdm.tqdm(**tqdm_args) as pbar:
+        yield from _imap(pool, fn, lst, ordered, chunksize, max_in_flight, chunk_seconds, pbar, max_workers)
+
+
+# Worker-side state of WorkerPool processes
+_worker_state = None
+_worker_shared: dict = {}
+_worker_shm: list = []
+
+
+def _init_worker(shared_specs: dict, initializer: Callable | None, initargs: tuple):
+    global _worker_state
+    if shared_specs:
+        import numpy as np
+        from multiprocessing.shared_memory import SharedMemory
+
+        for name, (shm_name, shape, dtype) in shared_specs.items():
+            shm = SharedMemory(shm_name)
+            arr = np.ndarray(shape, dtype, buffer=shm.buf)
+            arr.flags.writeable = False
+            # Keep the handle alive as long as the array is used
+            _worker_shm.append(shm)
+            _worker_shared[name] = arr
+
+    if initializer:
+        _worker_state = initializer(*initargs)
+
+
+def worker_state():
+    """
+    :return: The return value of the WorkerPool initializer in the current worker
+    """
+    return _worker_state
+
+
+def shared_array(name: str):
+    """
+    Get a read-only numpy array shared by the WorkerPool, without copying or pickling it
+
+    :param name: Name of the array passed in WorkerPool(shared=...)
+    """
+    return _worker_shared[name]
+
+
+class WorkerPool:
+    """
+    Process pool that stays warm across map calls, so modules are imported and heavy state is
+    loaded once per worker instead of once per call.
+
+    >>> def load(path): return load_model(path)
+    >>> def predict(x): return worker_state().predict(x, shared_array('table'))
+    >>> with WorkerPool(initializer=load, initargs=('model.bin',), shared={'table': table}) as pool:
+    ...     a = pool.pmap(predict, batch_a)
+    ...     b = pool.pmap(predict, batch_b)
+    """
+    def __init__(self, max_workers: int | None = None, initializer: Callable | None = None, initargs: tuple = (),
+                 shared: dict | None = None):
+        """
+        :param max_workers: Number of workers (defaults to the number of cpus)
+        :param initializer: Called once in each worker, its return value is available through worker_state()
+        :param initargs: Arguments for the initializer
+        :param shared: Read-only numpy arrays to place in shared memory, available through shared_array(name)
+        """
+        self.max_workers = max_workers or os.cpu_count()
+        self._shm = []
+        specs = {}
+        if shared:
+            import numpy as np
+            from multiprocessing.shared_memory import SharedMemory
+
+            for name, arr in shared.items():
+                arr = np.ascontiguousarray(arr)
+                shm = SharedMemory(create=True, size=max(1, arr.nbytes))
+                np.ndarray(arr.shape, arr.dtype, buffer=shm.buf)[...] = arr
+                self._shm.append(shm)
+                specs[name] = (shm.name, arr.shape, arr.dtype.str)
+
+        self._pool = ProcessPoolExecutor(self.max_workers, initializer=_init_worker,
+                                         initargs=(specs, initializer, initargs))
+
+    def imap(self, fn: Callable, lst: Iterable, ordered: bool = True, chunksize: int | None = None,
+             max_in_flight: int | None = None, chunk_seconds: float = 0.05, **kwargs) -> Iterator:
+        """
+        Streaming map on the pool, see imap for the arguments
+        """
+        tqdm_args = dict(position=0, leave=True, total=len(lst) if hasattr(lst, '__len__') else None)
+        tqdm_args.update(kwargs)
+        with tqdm.tqdm(**tqdm_args) as pbar:
+            yield from _imap(self._pool, fn, lst, ordered, chunksize, max_in_flight or self.max_workers * 1000,
+                             chunk_seconds, pbar, self.max_workers)
+
+    def pmap(self, fn: Callable, lst: Iterable, **kwargs) -> list:
+        return list(self.imap(fn, lst, **kwargs))
+
+    def close(self):
+        self._pool.shutdown()
+        for shm in self._shm:
+            shm.close()
+            shm.unlink()
+        self._shm = []
+
+    def __enter__(self) -> WorkerPool:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+async def _retry(coro_fn: Callable[[Any], Awaitable], item: Any, retries: int, backoff: float,
+                 retry_on: tuple[type[BaseException], ...], on_retry: Callable | None) -> Any:
+    for attempt in range(retries + 1):
+        try:
+            return await coro_fn(item)
+        except retry_on as e:
+            if attempt == retries:
+                raise
+            if on_retry:
+                on_retry(item, e, attempt)
+            # Exponential backoff
+            await asyncio.sleep(backoff * 2 ** attempt)
+
+
+async def aimap(coro_fn: Callable[[Any], Awaitable], lst: Iterable, concurrency: int = 64, ordered: bool = True,
+                retries: int = 0, backoff: float = 0.5, retry_on: tuple[type[BaseException], ...] = (Exception,),
+                on_retry: Callable[[Any, BaseException, int], Any] | None = None, **kwargs) -> AsyncIterator:
+    """
+    Async map with a progress bar, for I/O-bound work that needs far more concurrency than threads allow.
+
+    :param coro_fn: Async function to map
+    :param lst: Input iterable (consumed lazily, only up to concurrency items are started at a time)
+    :param concurrency: Maximum number of coroutines running at the same time (in ordered mode, also the
+        maximum number of results waiting for an earlier item)
+    :param ordered: Yield results in input order (True) or as they complete (False)
+    :param retries: Number of times to retry an item that raised one of retry_on
+    :param backoff: Delay before the first retry in seconds, doubled after each retry
+    :param retry_on: Exception types that should be retried
+    :param on_retry: Called with (item, exception, attempt) before each retry
+    :param kwargs: Extra arguments for tqdm (e.g. desc, total)
+    """
+    tqdm_args = dict(position=0, leave=True, total=len(lst) if hasattr(lst, '__len__') else None)
+    tqdm_args.update(kwargs)
+
+    sem = asyncio.Semaphore(concurrency)
+    results: asyncio.Queue = asyncio.Queue()
+    tasks = set()
+
+    async def run(i: int, item: Any):
+        try:
+            results.put_nowait((i, await _retry(coro_fn, item, retries, backoff, retry_on, on_retry), None))
+        except Exception as e:
+            results.put_nowait((i, None, e))
+        finally:
+            # In ordered mode the slot is only freed once the result is yielded, which bounds the reorder buffer
+            if not ordered:
+                sem.release()
+
+    async def feed():
+        n = 0
+        try:
+            for n, item in enumerate(lst, 1):
+                await sem.acquire()
+                task = asyncio.create_task(run(n - 1, item))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except Exception as e:
+            # Pass errors of the input iterable on to the consumer
+            results.put_nowait((None, None, e))
+            return
+        # Tell the consumer how many results to expect
+        results.put_nowait((None, n, None))
+
+    feeder = asyncio.create_task(feed())
+    total, received, next_i, buffer = None, 0, 0, {}
+    try:
+        with tqdm.tqdm(**tqdm_args) as pbar:
+            while total is None or received < total:
+                i, r, err = await results.get()
+                if err is not None:
+                    raise err
+                if i is None:
+                    total = r
+                    continue
+                received += 1
+                pbar.update(1)
+
+                if not ordered:
+                    yield r
+                    continue
+                buffer[i] = r
+                while next_i in buffer:
+                    sem.release()
+                    yield buffer.pop(next_i)
+                    next_i += 1
+    finally:
+        feeder.cancel()
+        for task in list(tasks):
+            task.cancel()
+
+
+def amap(coro_fn: Callable[[Any], Awaitable], lst: Iterable, **kwargs) -> list:
+    """
+    Synchronous wrapper of aimap for scripts, see aimap for the arguments
+
+    >>> async def fetch(url): ...
+    >>> pages = amap(fetch, urls, concurrency=1000, retries=3)
+    """
+    async def collect():
+        return [r async for r in aimap(coro_fn, lst, **kwargs)]
+    return asyncio.run(collect())
+
+
 def tq(it: Iterable, desc: str, *args, **kwargs) -> tqdm:
     tqdm_args = dict(position=0, leave=True)
     return tqdm.tqdm(it, desc, *args, **{**tqdm_args, **kwargs})
@@ -1,14 +1,152 @@
+from __future__ import annotations
+
+import mmap
+import os
 import pickle
+import struct
+import threading
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator
 
 import zstandard as zstd
 import orjson
 
-from . import write
+from . import write, ensure_parent
 
 zstd_d = zstd.ZstdDecompressor()
 zstd_c = zstd.ZstdCompressor(level=5, write_checksum=True, threads=-1)
 
+# Size of the decompressed/compressed window used by the streaming helpers
+STREAM_CHUNK_SIZE = 1 << 20
+
+# Trained dictionaries are stored next to the data with this suffix
+ZDICT_SUFFIX = '.zdict'
+# Largest possible zstd frame header, enough to read the dictionary id of a frame
+FRAME_HEADER_MAX_SIZE = 18
+
+# Registered dictionaries and their cached (de)compressors, keyed by dictionary id
+_zdicts: dict[int, zstd.ZstdCompressionDict] = {}
+_zdict_c: dict[tuple[int, int], zstd.ZstdCompressor] = {}
+_zdict_d: dict[int, zstd.ZstdDecompressor] = {}
+# Per-thread (de)compressors of the parallel helpers, since zstd contexts can't be shared across threads
+_local = threading.local()
+
+
+def register_zstd_dict(zdict: zstd.ZstdCompressionDict | bytes) -> zstd.ZstdCompressionDict:
+    """
+    Register a zstd dictionary so that files compressed with it can be loaded transparently.
+
+    Parameters:
+        zdict (ZstdCompressionDict or bytes): The dictionary, or its raw bytes.
+
+    Returns:
+        ZstdCompressionDict: The registered dictionary.
+    """
+    if isinstance(zdict, bytes):
+        zdict = zstd.ZstdCompressionDict(zdict)
+    _zdicts[zdict.dict_id()] = zdict
+    return zdict
+
+
+def load_zstd_dict(file_path: str | Path) -> zstd.ZstdCompressionDict:
+    """
+    Load a dictionary saved by train_zstd_dict and register it.
+
+    Parameters:
+        file_path (str): The path to the .zdict file.
+
+    Returns:
+        ZstdCompressionDict: The loaded dictionary.
+    """
+    return register_zstd_dict(Path(file_path).read_bytes())
+
+
+def train_zstd_dict(samples: Iterable[str | Path | bytes], dict_path: str | Path | None = None,
+                    dict_size: int = 112640) -> zstd.ZstdCompressionDict:
+    """
+    Train a zstd dictionary from sample payloads, which greatly improves compression ratio and
+    speed for many small files of similar structure.
+
+    Parameters:
+        samples (list): Sample payloads, either raw bytes or file paths. Paths ending with .zst
+            are decompressed before training.
+        dict_path (str): Where to save the dictionary (e.g. data_dir / 'data.zdict'), None to
+            skip saving.
+        dict_size (int): The maximum dictionary size in bytes.
+
+    Returns:
+        ZstdCompressionDict: The trained (and registered) dictionary.
+    """
+    def read_sample(s: str | Path | bytes) -> bytes:
+        if isinstance(s, bytes):
+            return s
+        s = Path(s)
+        if s.suffix == '.zst':
+            with s.open('rb') as f:
+                return _decompressor(f, s).stream_reader(f).read()
+        return s.read_bytes()
+
+    zdict = zstd.train_dictionary(dict_size, [read_sample(s) for s in samples])
+    if dict_path:
+        write(dict_path, zdict.as_bytes())
+    return register_zstd_dict(zdict)
+
+
+def _compressor(zdict: zstd.ZstdCompressionDict | None, level: int = 5) -> zstd.ZstdCompressor:
+    """
+    Get the compressor for a dictionary (or the shared compressor when there is no dictionary)
+    """
+    if zdict is None:
+        return zstd_c
+    key = (register_zstd_dict(zdict).dict_id(), level)
+    if key not in _zdict_c:
+        # Small payloads don't benefit from multithreading, so the dict compressor is single-threaded
+        _zdict_c[key] = zstd.ZstdCompressor(level=level, dict_data=zdict, write_checksum=True)
+    return _zdict_c[key]
+
+
+def _frame_dict_id(f) -> int:
+    """
+    Read the dictionary id from the frame header at the file position, and restore the position
+    """
+    pos = f.tell()
+    head = f.read(FRAME_HEADER_MAX_SIZE)
+    f.seek(pos)
+    return zstd.get_frame_parameters(head).dict_id if head else 0
+
+
+def _decompressor(f, file_path: str | Path, fresh: bool = False) -> zstd.ZstdDecompressor:
+    """
+    Get the decompressor for a file, picking the dictionary recorded in its frame header.
+
+    Dictionaries that aren't registered yet are looked up in *.zdict files next to the file.
+    The file position is restored after reading the header.
+    """
+    return _dict_decompressor(_frame_dict_id(f), file_path, fresh)
+
+
+def _dict_decompressor(dict_id: int, file_path: str | Path, fresh: bool = False) -> zstd.ZstdDecompressor:
+    """
+    Get the decompressor for a dictionary id (0 means no dictionary)
+    """
+    if not dict_id:
+        return zstd.ZstdDecompressor() if fresh else zstd_d
+
+    if dict_id not in _zdicts:
+        for p in Path(file_path).parent.glob(f'*{ZDICT_SUFFIX}'):
+            load_zstd_dict(p)
+    if dict_id not in _zdicts:
+        raise ValueError(f'{file_path} requires zstd dictionary {dict_id}, which is not registered')
+
+    if fresh:
+        return zstd.ZstdDecompressor(dict_data=_zdicts[dict_id])
+    if dict_id not in _zdict_d:
+        _zdict_d[dict_id] = zstd.ZstdDecompressor(dict_data=_zdicts[dict_id])
+    return _zdict_d[dict_id]
+
 
 def load_json_zst(file_path: str | Path) -> dict | list:
     """
@@ -21,27 +159,410 @@ def load_json_zst(file_path: str | Path) -> dict | list:
         dict or list: The parsed JSON content.
     """
     with Path(file_path).open('rb') as f:
-        return orjson.loads(zstd_d.stream_reader(f).read())
+        return orjson.loads(_decompressor(f, file_path).stream_reader(f).read())
 
 
-def write_json_zst(file_path: str | Path, data: dict | list, **kwargs):
+def write_json_zst(file_path: str | Path, data: dict | list, zdict: zstd.ZstdCompressionDict | None = None,
+                   **kwargs):
     """
     Dump data to a .json.zst file.
 
     Parameters:
         file_path (str): The path to the .json.zst file.
         data (dict or list): The data to dump.
+        zdict (ZstdCompressionDict): Optional trained dictionary to compress with.
     """
-    write(file_path, zstd_c.compress(orjson.dumps(data, **kwargs)))
+    write(file_path, _compressor(zdict).compress(orjson.dumps(data, **kwargs)))
 
 
 def load_pickle_zst(file_path: str | Path):
     with Path(file_path).open('rb') as f:
-        return pickle.loads(zstd_d.stream_reader(f).read())
+        return pickle.loads(_decompressor(f, file_path).stream_reader(f).read())
+
+
+def write_pickle_zst(file_path: str | Path, data, zdict: zstd.ZstdCompressionDict | None = None):
+    write(file_path, _compressor(zdict).compress(pickle.dumps(data)))
+
+
+def iter_jsonl_zst(file_path: str | Path, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[Any]:
+    """
+    Lazily iterate over the records of a .jsonl.zst file (one JSON value per line).
+
+    Only one decompressed chunk and one partial line are held in memory at a time, so memory usage
+    does not depend on the file size.
+
+    Parameters:
+        file_path (str): The path to the .jsonl.zst file.
+        chunk_size (int): The number of decompressed bytes to read at a time.
+
+    Returns:
+        Iterator: The parsed records, in file order.
+    """
+    with Path(file_path).open('rb') as f:
+        # A fresh decompressor is used so that several files can be iterated at the same time
+        dctx = _decompressor(f, file_path, fresh=True)
+        with dctx.stream_reader(f, read_size=chunk_size) as reader:
+            tail = b''
+            while chunk := reader.read(chunk_size):
+                lines = (tail + chunk).split(b'\n')
+                tail = lines.pop()
+                for line in lines:
+                    if line.strip():
+                        yield orjson.loads(line)
+            if tail.strip():
+                yield orjson.loads(tail)
+
+
+class JsonlZstWriter:
+    """
+    Context manager that streams records into a .jsonl.zst file, one JSON value per line.
+
+    Records are compressed as they are written, so the full output never has to fit in memory.
+
+    >>> with JsonlZstWriter('out.jsonl.zst') as w:
+    ...     for record in records:
+    ...         w.write(record)
+    """
+    def __init__(self, file_path: str | Path, level: int = 5, chunk_size: int = STREAM_CHUNK_SIZE,
+                 zdict: zstd.ZstdCompressionDict | None = None, **kwargs):
+        """
+        Parameters:
+            file_path (str): The path to the .jsonl.zst file.
+            level (int): The zstd compression level.
+            chunk_size (int): The number of compressed bytes to buffer before writing to disk.
+            zdict (ZstdCompressionDict): Optional trained dictionary to compress with.
+            kwargs: Extra arguments passed to orjson.dumps (e.g. option, default).
+        """
+        self.file_path = Path(file_path)
+        self.chunk_size = chunk_size
+        self.kwargs = kwargs
+        # Each writer needs its own compressor, the shared zstd_c can't hold an open stream
+        zdict = register_zstd_dict(zdict) if zdict is not None else None
+        self._compressor = zstd.ZstdCompressor(level=level, write_checksum=True, threads=-1, dict_data=zdict)
+        self._writer = None
+        self.count = 0
+
+    def __enter__(self) -> JsonlZstWriter:
+        f = ensure_parent(self.file_path).open('wb')
+        self._writer = self._compressor.stream_writer(f, write_size=self.chunk_size)
+        return self
+
+    def write(self, record: Any):
+        """
+        Serialize one record and append it to the stream.
+        """
+        self._writer.write(orjson.dumps(record, **self.kwargs) + b'\n')
+        self.count += 1
+
+    def write_all(self, records: Iterable[Any]):
+        for r in records:
+            self.write(r)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Closing the zstd writer flushes the final frame and closes the file
+        self._writer.close()
+        self._writer = None
+
+
+def _local_ctx(key: tuple, create: Callable[[], Any]) -> Any:
+    """
+    Get a (de)compressor owned by the current thread, creating it on first use. Loading a dictionary
+    into a context is much slower than compressing a small document, so the contexts are kept for
+    all tasks run by the same worker thread or process.
+    """
+    ctxs = getattr(_local, 'ctxs', None)
+    if ctxs is None:
+        ctxs = _local.ctxs = {}
+    if key not in ctxs:
+        ctxs[key] = create()
+    return ctxs[key]
+
+
+def _register_zstd_dicts(zdicts: list[bytes]):
+    # Process pool initializer, so that workers know the dictionaries registered in the parent
+    for d in zdicts:
+        register_zstd_dict(d)
+
+
+def _load_json_zst_task(file_path: str | Path) -> tuple[str | Path, Any]:
+    with Path(file_path).open('rb') as f:
+        dict_id = _frame_dict_id(f)
+        dctx = _local_ctx(('d', dict_id), lambda: _dict_decompressor(dict_id, file_path, fresh=True))
+        return file_path, orjson.loads(dctx.stream_reader(f).read())
+
+
+def _write_json_zst_task(file_path: str | Path, data: Any, level: int, dict_id: int, kwargs: dict) -> str | Path:
+    # Parallelism is across files, so the per-thread compressor is single-threaded
+    cctx = _local_ctx(('c', level, dict_id), lambda: zstd.ZstdCompressor(
+        level=level, write_checksum=True, dict_data=_zdicts[dict_id] if dict_id else None))
+    write(file_path, cctx.compress(orjson.dumps(data, **kwargs)))
+    return file_path
+
+
+def _bounded_map(fn: Callable, tasks: Iterable[tuple], workers: int | None, processes: bool, ordered: bool,
+                 max_in_flight: int | None) -> Iterator:
+    """
+    Run fn(*task) for each task on a pool, keeping at most max_in_flight tasks submitted at a time
+
+    :return: Results in task order (ordered) or completion order
+    """
+    workers = workers or os.cpu_count()
+    max_in_flight = max_in_flight or workers * 2
+    tasks = iter(tasks)
+    pool: Executor = ProcessPoolExecutor(workers, initializer=_register_zstd_dicts,
+                                         initargs=([d.as_bytes() for d in _zdicts.values()],)) \
+        if processes else ThreadPoolExecutor(workers)
+
+    with pool:
+        pending: deque[Future] | set[Future] = deque() if ordered else set()
+
+        def submit() -> bool:
+            task = next(tasks, None)
+            if task is None:
+                return False
+            fut = pool.submit(fn, *task)
+            if ordered:
+                pending.append(fut)
+            else:
+                pending.add(fut)
+            return True
+
+        while len(pending) < max_in_flight and submit():
+            pass
+
+        while pending:
+            if ordered:
+                done = [pending.popleft()]
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                pending.difference_update(done)
+            for fut in done:
+                yield fut.result()
+                submit()
+
+
+def load_many_json_zst(file_paths: Iterable[str | Path], workers: int | None = None, processes: bool = False,
+                       ordered: bool = True, max_in_flight: int | None = None) -> Iterator[tuple[str | Path, Any]]:
+    """
+    Load many .json.zst files in parallel.
+
+    Decompression releases the GIL, so threads scale well for it. For large documents where the JSON
+    parsing dominates, use processes=True instead.
+
+    Parameters:
+        file_paths (list): The paths to load, can be a lazy iterable.
+        workers (int): The number of workers (defaults to the number of cpus).
+        processes (bool): Whether to use a process pool instead of a thread pool.
+        ordered (bool): Yield results in input order (True) or as soon as they complete (False).
+        max_in_flight (int): Maximum number of files being loaded or waiting to be consumed, which
+            bounds memory usage (defaults to 2 * workers).
+
+    Returns:
+        Iterator: (path, parsed content) tuples.
+    """
+    return _bounded_map(_load_json_zst_task, ((p,) for p in file_paths), workers, processes, ordered, max_in_flight)
+
+
+def write_many_json_zst(items: Iterable[tuple[str | Path, Any]], workers: int | None = None, processes: bool = False,
+                        level: int = 5, zdict: zstd.ZstdCompressionDict | None = None,
+                        max_in_flight: int | None = None, **kwargs) -> int:
+    """
+    Dump many objects to .json.zst files in parallel.
 
+    Parameters:
+        items (list): (path, data) tuples, can be a lazy iterable.
+        workers (int): The number of workers (defaults to the number of cpus).
+        processes (bool): Whether to use a process pool instead of a thread pool.
+        level (int): The zstd compression level.
+        zdict (ZstdCompressionDict): Optional trained dictionary to compress with.
+        max_in_flight (int): Maximum number of objects queued at a time (defaults to 2 * workers).
+        kwargs: Extra arguments passed to orjson.dumps.
+
+    Returns:
+        int: The number of files written.
+    """
+    dict_id = register_zstd_dict(zdict).dict_id() if zdict is not None else 0
+    tasks = ((p, data, level, dict_id, kwargs) for p, data in items)
+    return sum(1 for _ in _bounded_map(_write_json_zst_task, tasks, workers, processes, False, max_in_flight))
+
+
+class ZstArchive:
+    """
+    Seekable archive of many independently compressed objects, indexed by string keys.
+
+    Layout: one zstd frame per object, followed by a compressed JSON index
+    (key -> [offset, length, dict id]) and a fixed-size trailer pointing to the index. Reads go
+    through mmap, so a lookup only touches the frame it needs.
+
+    Appending writes the new frames, index and trailer after the existing trailer, so if the process
+    dies before close() the old index is still found and the archive reopens in its previous state.
+    Writing a key that already exists makes the index point to the new frame (the old frame is kept
+    but no longer reachable).
+
+    >>> with ZstArchive('objs.zar', 'w') as ar:
+    ...     ar['a'] = {'meow': 1}
+    >>> with ZstArchive('objs.zar') as ar:
+    ...     ar.get('a')
+    {'meow': 1}
+    """
+    MAGIC = b'HYZARC01'
+    TRAILER = struct.Struct('<QQ8s')
+
+    def __init__(self, file_path: str | Path, mode: str = 'r', fmt: str = 'pickle', level: int = 5,
+                 zdict: zstd.ZstdCompressionDict | None = None):
+        """
+        Parameters:
+            file_path (str): The path to the archive.
+            mode (str): 'r' to read, 'w' to create (or truncate), 'a' to append (creates if missing).
+            fmt (str): 'pickle' or 'json', used for new archives (existing archives keep their format).
+            level (int): The zstd compression level for new objects.
+            zdict (ZstdCompressionDict): Optional trained dictionary to compress new objects with.
+        """
+        assert mode in ('r', 'w', 'a'), f'Unsupported mode {mode}'
+        assert fmt in ('pickle', 'json'), f'Unsupported format {fmt}'
+        self.file_path = Path(file_path)
+        self.mode = mode
+        self.fmt = fmt
+        self.dict_id = 0
+        self.index: dict[str, list[int]] = {}
+        self._mm = None
+        self._dctx: dict[int, zstd.ZstdDecompressor] = {}
+
+        if mode == 'a' and not self.file_path.is_file():
+            mode = 'w'
+        if mode == 'w':
+            self._f = ensure_parent(self.file_path).open('w+b')
+            self._end = 0
+        else:
+            self._f = self.file_path.open('rb' if mode == 'r' else 'r+b')
+            self._end = self._read_index()
+            if mode == 'r':
+                self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # Drop whatever an interrupted append left after the last complete trailer
+                self._f.truncate(self._end)
+
+        if mode != 'r':
+            if zdict is not None:
+                zdict = register_zstd_dict(zdict)
+                self.dict_id = zdict.dict_id()
+            self._cctx = zstd.ZstdCompressor(level=level, dict_data=zdict, write_checksum=True)
+            # New frames go after the old trailer, which stays valid until the new one is written
+            self._f.seek(self._end)
+
+    def _try_index(self, end: int) -> dict | None:
+        """
+        Read the index whose trailer ends at offset end, or None if there is no valid trailer there
+        """
+        if end < self.TRAILER.size:
+            return None
+        self._f.seek(end - self.TRAILER.size)
+        offset, length, magic = self.TRAILER.unpack(self._f.read(self.TRAILER.size))
+        if magic != self.MAGIC or offset + length != end - self.TRAILER.size:
+            return None
+        self._f.seek(offset)
+        try:
+            return orjson.loads(zstd_d.decompress(self._f.read(length)))
+        except (zstd.ZstdError, orjson.JSONDecodeError):
+            return None
+
+    def _read_index(self) -> int:
+        """
+        Read the index from the end of the file, or from the last complete trailer if an append was
+        interrupted
+
+        :return: Offset where the archive ends (after the trailer)
+        """
+        end = self._f.seek(0, os.SEEK_END)
+        meta = self._try_index(end)
+        if meta is None:
+            with mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ) if end else nullcontext(b'') as mm:
+                pos = mm.rfind(self.MAGIC)
+                while pos >= 0 and (meta := self._try_index(pos + len(self.MAGIC))) is None:
+                    pos = mm.rfind(self.MAGIC, 0, pos)
+            if meta is None:
+                raise ValueError(f'{self.file_path} is not a zstd archive')
+            end = pos + len(self.MAGIC)
 
-def write_pickle_zst(file_path: str | Path, data):
-    write(file_path, zstd_c.compress(pickle.dumps(data)))
+        self.fmt, self.index = meta['fmt'], meta['index']
+        # Archives written before per-member dict ids stored one for the whole archive
+        for entry in self.index.values():
+            if len(entry) == 2:
+                entry.append(meta.get('dict_id', 0))
+        return end
+
+    def _write_index(self):
+        body = zstd_c.compress(orjson.dumps({'fmt': self.fmt, 'index': self.index}))
+        self._f.seek(self._end)
+        self._f.write(body)
+        self._f.write(self.TRAILER.pack(self._end, len(body), self.MAGIC))
+        self._f.truncate()
+
+    def keys(self):
+        return self.index.keys()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """
+        Decompress and deserialize one object, without touching the rest of the archive.
+        """
+        if key not in self.index:
+            return default
+        offset, length, dict_id = self.index[key]
+
+        if self._mm is not None:
+            raw = self._mm[offset:offset + length]
+        else:
+            self._f.seek(offset)
+            raw = self._f.read(length)
+            self._f.seek(self._end)
+
+        if dict_id not in self._dctx:
+            self._dctx[dict_id] = _dict_decompressor(dict_id, self.file_path, fresh=True)
+        data = self._dctx[dict_id].decompress(raw)
+        return pickle.loads(data) if self.fmt == 'pickle' else orjson.loads(data)
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.index:
+            raise KeyError(key)
+        return self.get(key)
+
+    def put(self, key: str, obj: Any):
+        """
+        Compress one object as its own frame and add it to the index.
+        """
+        assert self.mode != 'r', 'Archive is opened read-only'
+        data = pickle.dumps(obj) if self.fmt == 'pickle' else orjson.dumps(obj)
+        frame = self._cctx.compress(data)
+        self._f.write(frame)
+        self.index[key] = [self._end, len(frame), self.dict_id]
+        self._end += len(frame)
+
+    def __setitem__(self, key: str, obj: Any):
+        self.put(key, obj)
+
+    def close(self):
+        if self._f.closed:
+            return
+        if self._mm is not None:
+            self._mm.close()
+        if self.mode != 'r':
+            self._write_index()
+        self._f.close()
+
+    def __enter__(self) -> ZstArchive:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
 if __name__ == '__main__':
@@ -49,3 +570,30 @@ if __name__ == '__main__':
     assert load_pickle_zst('test.pickle.zst') == {'a': 1, 'b': 2}
     write_json_zst('test.json.zst', {'a': 1, 'b': 2})
     assert load_json_zst('test.json.zst') == {'a': 1, 'b': 2}
+    with JsonlZstWriter('test.jsonl.zst') as w:
+        w.write_all({'i': i} for i in range(100000))
+    assert list(iter_jsonl_zst('test.jsonl.zst')) == [{'i': i} for i in range(100000)]
+
+    # Dictionary compression for many small payloads
+    for i in range(200):
+        write_json_zst(f'test_zdict/{i}.json.zst', {'id': i, 'name': f'user {i}', 'tags': ['a', 'b', str(i % 7)]})
+    zd = train_zstd_dict(Path('test_zdict').glob('*.json.zst'), 'test_zdict/data.zdict', dict_size=4096)
+    write_json_zst('test_zdict/small.json.zst', {'id': 1, 'name': 'user 1', 'tags': ['a', 'b', '1']}, zdict=zd)
+    _zdicts.clear()
+    _zdict_d.clear()
+    assert load_json_zst('test_zdict/small.json.zst') == {'id': 1, 'name': 'user 1', 'tags': ['a', 'b', '1']}
+
+    # Seekable archive
+    with ZstArchive('test.zar', 'w') as ar:
+        for i in range(1000):
+            ar[str(i)] = {'i': i}
+    with ZstArchive('test.zar', 'a') as ar:
+        ar['extra'] = [1, 2, 3]
+    with ZstArchive('test.zar') as ar:
+        assert len(ar) == 1001 and ar['500'] == {'i': 500} and ar.get('extra') == [1, 2, 3]
+
+    # Parallel multi-file pipeline
+    write_many_json_zst((f'test_many/{i}.json.zst', {'i': i}) for i in range(100))
+    paths = [f'test_many/{i}.json.zst' for i in range(100)]
+    assert [d for _, d in load_many_json_zst(paths)] == [{'i': i} for i in range(100)]
+    assert sorted(d['i'] for _, d in load_many_json_zst(paths, processes=True, ordered=False)) == list(range(100))
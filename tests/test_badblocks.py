@@ -0,0 +1,74 @@
+import errno
+import os
+from pathlib import Path
+
+import pytest
+
+from hypy_utils.badblocks import LogStore, NativeVerifier
+
+
+def record(start: int) -> dict:
+    return {"start_block": start, "end_block": start + 10, "bad_blocks": [], "time": 1.0}
+
+
+def test_log_repair_long_broken_record(tmp_path: Path):
+    log = LogStore(tmp_path / "scan.jsonl", fsync="never")
+    log.create(4096)
+    log.append(record(0))
+    log.close()
+
+    # A crash in the middle of a record longer than one repair block
+    with log.path.open("ab") as f:
+        f.write(b'{"start_block": 10, "stderr": "' + b"x" * 200_000)
+
+    log.append(record(10))
+    log.close()
+    assert [r["start_block"] for r in log.records()] == [0, 10]
+    assert log.tail()["start_block"] == 10
+
+
+def make_image(tmp_path: Path, size: int = 64 * 1024 * 1024) -> str:
+    # Sparse image file standing in for a disk
+    path = tmp_path / "disk.img"
+    with path.open("wb") as f:
+        f.truncate(size)
+    return str(path)
+
+
+def test_native_verifier_clean_image(tmp_path: Path):
+    v = NativeVerifier(make_image(tmp_path), 4096, read_size=1024 * 1024)
+    try:
+        assert v.verify(0, 16384) == ([], "")
+    finally:
+        v.close()
+
+
+def test_native_verifier_rejects_misaligned_block_size(tmp_path: Path):
+    # E.g. -b 512 on a 4Kn disk
+    with pytest.raises(ValueError):
+        NativeVerifier(make_image(tmp_path), 512, sector_size=4096)
+
+
+def test_native_verifier_einval_is_not_a_bad_block(tmp_path: Path, monkeypatch):
+    v = NativeVerifier(make_image(tmp_path), 4096, read_size=1024 * 1024)
+    real_preadv = os.preadv
+
+    def preadv(fd, buffers, offset):
+        # Block 1000 is unreadable
+        if offset <= 4096 * 1000 < offset + len(buffers[0]):
+            raise OSError(errno.EIO, "Input/output error")
+        return real_preadv(fd, buffers, offset)
+
+    try:
+        monkeypatch.setattr(os, "preadv", preadv)
+        bad, errors = v.verify(0, 2048)
+        assert bad == [1000] and "Input/output error" in errors
+
+        def misaligned(fd, buffers, offset):
+            raise OSError(errno.EINVAL, "Invalid argument")
+
+        monkeypatch.setattr(os, "preadv", misaligned)
+        with pytest.raises(OSError):
+            v.verify(0, 2048)
+    finally:
+        v.close()
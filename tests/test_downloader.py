@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+import requests
+
+from hypy_utils import downloader
+from hypy_utils.downloader import download_file, download_many
+
+SIZE = 1 << 20
+
+
+class Server:
+    """
+    Local stand-in for a file server, optionally with range requests and dropped connections
+    """
+    def __init__(self):
+        self.files: dict[str, bytes] = {}
+        self.ranges = True
+        # Range start -> bytes to send before dropping the connection (once)
+        self.drop: dict[int, int] = {}
+        self.requests: list[tuple[str, str, str | None]] = []
+        self.lock = threading.Lock()
+
+    def etag(self, path: str) -> str:
+        return f'"{hashlib.md5(self.files[path]).hexdigest()}"'
+
+    def url(self, path: str) -> str:
+        return f'http://127.0.0.1:{self.httpd.server_port}{path}'
+
+    def __enter__(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send_headers(self, code: int, length: int):
+                self.send_response(code)
+                self.send_header('Content-Length', str(length))
+                self.send_header('ETag', server.etag(self.path))
+                if server.ranges:
+                    self.send_header('Accept-Ranges', 'bytes')
+                self.end_headers()
+
+            def do_HEAD(self):
+                with server.lock:
+                    server.requests.append(('HEAD', self.path, None))
+                self.send_headers(200, len(server.files[self.path]))
+
+            def do_GET(self):
+                rng = self.headers.get('Range')
+                with server.lock:
+                    server.requests.append(('GET', self.path, rng))
+                data = server.files[self.path]
+                if rng and server.ranges:
+                    start, end = map(int, rng.removeprefix('bytes=').split('-'))
+                    body = data[start:end + 1]
+                    self.send_headers(206, len(body))
+                    with server.lock:
+                        cut = server.drop.pop(start, None)
+                    if cut is not None:
+                        # Send part of the body, then close the connection
+                        self.wfile.write(body[:cut])
+                        self.close_connection = True
+                        return
+                else:
+                    body = data
+                    self.send_headers(200, len(body))
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The downloader closes the initial GET once it knows the headers
+                    pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server(monkeypatch):
+    # Segment small files too, so that the tests stay fast
+    monkeypatch.setattr(downloader, 'MIN_SEGMENT_SIZE', 64 * 1024)
+    with Server() as s:
+        yield s
+
+
+def test_resume_interrupted_segment(server: Server, tmp_path: Path):
+    data = server.files['/a.bin'] = os.urandom(SIZE)
+    file = tmp_path / 'a.bin'
+    part, map_path = tmp_path / 'a.bin.part', tmp_path / 'a.bin.part.json'
+
+    # The second of four segments drops after 100 KB
+    seg = SIZE // 4
+    server.drop[seg] = 100 * 1024
+    with pytest.raises(requests.RequestException):
+        download_file(server.url('/a.bin'), file, progress=False, segments=4, chunk_size=16 * 1024)
+    assert not file.exists() and part.is_file()
+
+    # The map only records what was written, and never runs ahead of the data
+    segments = json.loads(map_path.read_text())['segments']
+    assert segments[1][:2] == [seg, 2 * seg] and 0 < segments[1][2] <= 100 * 1024
+    assert [s[2] for s in segments[::2]] == [seg, seg]
+    done = segments[1][2]
+    assert part.read_bytes()[seg:seg + done] == data[seg:seg + done]
+
+    server.requests.clear()
+    download_file(server.url('/a.bin'), file, progress=False, segments=4, chunk_size=16 * 1024)
+    assert file.read_bytes() == data
+    assert not part.exists() and not map_path.exists()
+    # Only the rest of the interrupted segment is fetched again
+    assert [r[2] for r in server.requests if r[2]] == [f'bytes={seg + done}-{2 * seg - 1}']
+
+
+def test_server_without_ranges(server: Server, tmp_path: Path):
+    server.ranges = False
+    data = server.files['/b.bin'] = os.urandom(SIZE)
+    file = tmp_path / 'b.bin'
+    download_file(server.url('/b.bin'), file, progress=False, segments=4)
+    assert file.read_bytes() == data
+    assert server.requests == [('GET', '/b.bin', None)]
+    assert not (tmp_path / 'b.bin.part.json').exists()
+
+
+def test_checksum_mismatch(server: Server, tmp_path: Path):
+    data = server.files['/c.bin'] = os.urandom(SIZE)
+    file = tmp_path / 'c.bin'
+    with pytest.raises(IOError):
+        download_file(server.url('/c.bin'), file, progress=False, checksum='md5:' + '0' * 32)
+    assert list(tmp_path.iterdir()) == []
+
+    download_file(server.url('/c.bin'), file, progress=False, checksum='md5:' + hashlib.md5(data).hexdigest())
+    assert file.read_bytes() == data
+
+
+def test_download_many_skips_existing_and_checks_etags(server: Server, tmp_path: Path):
+    server.files['/x'] = b'x' * 1000
+    server.files['/y'] = b'y' * 1000
+    manifest = tmp_path / 'manifest.json'
+    x, y = tmp_path / 'x', tmp_path / 'y'
+    x.write_bytes(b'local')
+    urls = {server.url('/x'): x, server.url('/y'): y}
+
+    assert download_many(urls, progress=False, manifest=manifest) == urls
+    assert x.read_bytes() == b'local' and y.read_bytes() == b'y' * 1000
+    assert ('GET', '/x', None) not in server.requests
+    assert json.loads(manifest.read_text()) == {str(y): server.etag('/y')}
+
+    # Same size, new content: only the ETag tells them apart
+    server.files['/y'] = b'z' * 1000
+    server.requests.clear()
+    download_many(urls, progress=False, manifest=manifest)
+    assert y.read_bytes() == b'y' * 1000 and server.requests == []
+
+    download_many(urls, progress=False, manifest=manifest, check_remote=True)
+    assert y.read_bytes() == b'z' * 1000
+    # x differs in size from the remote file, so it is downloaded again as well
+    assert x.read_bytes() == b'x' * 1000
+    assert json.loads(manifest.read_text()) == {str(x): server.etag('/x'), str(y): server.etag('/y')}
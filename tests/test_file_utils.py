@@ -0,0 +1,58 @@
+import random
+
+import pytest
+
+from hypy_utils.file_utils import FILENAME_BLACKLIST, FILENAME_REPLACE, RESERVED_NAMES, _unescape_codes, \
+    escape_filename, escape_filenames, unescape_filename, unescape_filenames
+
+# Characters and fragments that need escaping, or look like escape codes
+ALPHABET = [*FILENAME_BLACKLIST, '%', '%%', '.', 'a', 'Z', '1', 'é', '%Lw', 'con', 'Com1', 'Q09O', '=']
+
+
+def legacy_escape_filename(fn: str) -> str:
+    fn = fn.replace("%", "[ PeRcEnT EsCaPe owo ]")
+    for c, r in FILENAME_REPLACE.items():
+        fn = fn.replace(c, r)
+    return fn.replace("[ PeRcEnT EsCaPe owo ]", "%%")
+
+
+def random_names(rng: random.Random, n: int, alphabet: list[str] = ALPHABET) -> list[str]:
+    return [''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 8))) for _ in range(n)]
+
+
+def test_codes_are_prefix_free():
+    # The single pass decoder can't split a code wrongly
+    codes = list(_unescape_codes)
+    assert not any(a != b and b.startswith(a) for a in codes for b in codes)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_escape_round_trip(seed: int):
+    for fn in random_names(random.Random(seed), 20000):
+        esc = escape_filename(fn)
+        assert unescape_filename(esc) == fn, (fn, esc)
+        assert not any(c in esc for c in FILENAME_BLACKLIST if len(c) == 1), (fn, esc)
+        assert esc.partition('.')[0].upper() not in RESERVED_NAMES, (fn, esc)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_escape_matches_legacy(seed: int):
+    # Names without reserved devices are escaped exactly as before, and old names still unescape
+    for fn in random_names(random.Random(seed), 20000):
+        if not any(n in fn.upper() for n in RESERVED_NAMES):
+            assert escape_filename(fn) == legacy_escape_filename(fn), fn
+        assert unescape_filename(legacy_escape_filename(fn)) == fn, fn
+
+
+def test_reserved_names():
+    assert escape_filename('CONFIG.txt') == 'CONFIG.txt'
+    assert escape_filename('con.tar.gz') == '%Y29u.tar.gz'
+
+
+@pytest.mark.parametrize('newlines', [True, False])
+def test_batch_matches_single(newlines: bool):
+    names = random_names(random.Random(0), 10000, ALPHABET + ['\n'] if newlines else ALPHABET)
+    assert escape_filenames(names) == [escape_filename(fn) for fn in names]
+    assert unescape_filenames(escape_filenames(names)) == names
+    assert escape_filenames([]) == unescape_filenames([]) == []
+    assert escape_filenames(['']) == ['']
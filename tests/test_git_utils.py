@@ -0,0 +1,64 @@
+import os
+import subprocess
+from pathlib import Path
+
+from hypy_utils.git_utils import GitLogCache, git_log
+
+ENV = {'GIT_AUTHOR_NAME': 'a', 'GIT_AUTHOR_EMAIL': 'a@b', 'GIT_COMMITTER_NAME': 'a', 'GIT_COMMITTER_EMAIL': 'a@b'}
+
+
+def git(repo: Path, *args: str, date: int | None = None):
+    env = dict(ENV)
+    if date is not None:
+        env['GIT_AUTHOR_DATE'] = env['GIT_COMMITTER_DATE'] = f'{1600000000 + date * 60} +0000'
+    subprocess.run(['git', '-C', str(repo), *args], check=True, capture_output=True, env={**os.environ, **env})
+
+
+def commit(repo: Path, name: str, date: int):
+    (repo / name).write_text(name)
+    git(repo, 'add', name)
+    git(repo, 'commit', '-q', '-m', name, date=date)
+
+
+def test_cache_matches_uncached_log_after_merge(tmp_path: Path):
+    repo, cache = tmp_path / 'repo', tmp_path / 'cache'
+    repo.mkdir()
+    git(repo, 'init', '-q', '-b', 'main')
+    commit(repo, 'c1', 1)
+    git(repo, 'checkout', '-q', '-b', 'side')
+    # The side branch has commits older than the next main commit
+    commit(repo, 'side1', 2)
+    commit(repo, 'side2', 4)
+    git(repo, 'checkout', '-q', 'main')
+    commit(repo, 'c2', 3)
+    commit(repo, 'c3', 5)
+    assert git_log(repo, cache_dir=cache) == git_log(repo)
+
+    git(repo, 'merge', '-q', '--no-ff', '-m', 'merge', 'side', date=6)
+    commit(repo, 'c4', 7)
+    assert [c.message for c in git_log(repo, cache_dir=cache)] == [c.message for c in git_log(repo)]
+    assert git_log(repo, cache_dir=cache) == git_log(repo)
+    # The merge is read incrementally instead of rebuilding the cache
+    assert GitLogCache(repo, cache).meta['segments'] == 2
+
+    # A merge of a branch with commits older than the cached ones
+    git(repo, 'checkout', '-q', '-b', 'old', 'HEAD~3')
+    commit(repo, 'old1', 3)
+    git(repo, 'checkout', '-q', 'main')
+    git(repo, 'commit', '-q', '--allow-empty', '-m', 'empty', date=8)
+    git(repo, 'merge', '-q', '--no-ff', '-m', 'merge old', 'old', date=9)
+    assert git_log(repo, cache_dir=cache) == git_log(repo)
+    assert GitLogCache(repo, cache).meta['segments'] == 3
+
+    # Linear commits on top of the cache are still read incrementally
+    commit(repo, 'c5', 10)
+    assert git_log(repo, cache_dir=cache) == git_log(repo)
+
+
+def test_file_names_with_newlines(tmp_path: Path):
+    repo = tmp_path / 'repo'
+    repo.mkdir()
+    git(repo, 'init', '-q', '-b', 'main')
+    commit(repo, 'trail\n', 1)
+    commit(repo, '\nlead', 2)
+    assert [c.file_names for c in git_log(repo)] == [['A/\nlead'], ['A/trail\n']]
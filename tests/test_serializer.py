@@ -0,0 +1,115 @@
+import copy
+import datetime
+import json
+import math
+import pickle
+import re
+from types import SimpleNamespace
+from enum import Enum
+
+import pytest
+
+from hypy_utils import serializer
+from hypy_utils.serializer import EnhancedJSONEncoder, HashCache, LazyNamespace, hash_files, json_stringify, \
+    jsn, parse_date_times, write_json
+
+
+class Color(Enum):
+    A = 1
+
+
+OPTIONS = [dict(indent=2), dict(separators=(',', ':')), dict(separators=(',', ':'), sort_keys=True)]
+VALUES = [
+    {'enum': Color.A},
+    {'nan': math.nan, 'inf': math.inf, 'ninf': -math.inf},
+    {'floats': [1e16, 1e-7, 0.1, 1.5e300, -0.0, 123456789.125]},
+    {'date': datetime.datetime(2021, 10, 20, 23, 50, 14), 'set': {1}, 'text': 'héllo "quoted"\n'},
+    [1, [2, {'b': None, 'a': True}], 'x'],
+]
+
+
+@pytest.mark.parametrize('kwargs', OPTIONS)
+@pytest.mark.parametrize('value', VALUES)
+def test_json_stringify_matches_stdlib(value, kwargs):
+    expected = json.dumps(value, ensure_ascii=False, cls=EnhancedJSONEncoder, **kwargs)
+    assert json_stringify(value, forced=False, **kwargs) == expected
+
+
+@pytest.mark.parametrize('kwargs', OPTIONS)
+def test_write_json_matches_stdlib(tmp_path, kwargs):
+    for i, value in enumerate(VALUES):
+        write_json(tmp_path / f'{i}.json', value, forced=False, **kwargs)
+        assert (tmp_path / f'{i}.json').read_text('utf-8') == \
+            json.dumps(value, ensure_ascii=False, cls=EnhancedJSONEncoder, **kwargs)
+
+
+def test_non_str_keys_rejected_by_default():
+    with pytest.raises(TypeError):
+        json_stringify({datetime.date(2021, 1, 1): 1}, separators=(',', ':'))
+
+
+@pytest.mark.parametrize('kwargs', OPTIONS)
+def test_fast_path_matches_stdlib_for_plain_data(kwargs):
+    pytest.importorskip('orjson')
+    value = {'text': 'héllo "quoted"\n', 'items': [1, 2.5, None, True, {'k': 'v'}],
+             'date': datetime.datetime(2021, 10, 20, 23, 50, 14)}
+    assert json_stringify(value, fast=True, **kwargs) == json_stringify(value, **kwargs)
+
+
+def test_hash_cache_skips_files_modified_while_hashing(tmp_path, monkeypatch):
+    file = tmp_path / 'a.txt'
+    file.write_text('old')
+    hash_file = serializer.hash_file
+
+    def modifying_hash_file(path, *args):
+        digest = hash_file(path, *args)
+        file.write_text('new content')
+        return digest
+
+    cache = HashCache(tmp_path / 'cache.json')
+    monkeypatch.setattr(serializer, 'hash_file', modifying_hash_file)
+    hash_files([file], cache=cache)
+    assert cache.get(file) is None
+
+    monkeypatch.setattr(serializer, 'hash_file', hash_file)
+    digest = hash_files([file], cache=cache)[file]
+    assert cache.get(file) == digest == serializer.md5(file)
+
+
+def test_lazy_namespace_copy_and_pickle():
+    ns = LazyNamespace({'a': {'b': [1, 2]}, 'to_dict': 1})
+    for clone in (copy.copy(ns), copy.deepcopy(ns), pickle.loads(pickle.dumps(ns))):
+        assert clone == ns and clone.a.b[1] == 2
+    assert copy.deepcopy(ns).to_dict() is not ns.to_dict()
+    assert ns.missing is None and ns['to_dict'] == 1
+    with pytest.raises(AttributeError):
+        ns.__missing_dunder__
+
+
+ISOS = ['2021-10-20T23:50:14', '2021-10-20T23:50:14.5+02:00', '2021-10-20T23:50:14.123Z',
+        '2021-10-20T23:50:14.1234567-05:30', '2021-10-20']
+
+
+def test_parse_date_times_py310(monkeypatch):
+    # Python 3.10 fromisoformat only accepts 3 or 6 fractional digits and no Z suffix
+    for iso in ISOS:
+        fixed = serializer._iso_for_py310(iso)
+        assert not fixed.endswith('Z')
+        assert re.fullmatch(r'[^.]*(\.\d{6}[^.]*)?', fixed), fixed
+
+    expected = parse_date_times(ISOS)
+    assert expected[1] == datetime.datetime(2021, 10, 20, 23, 50, 14, 500000,
+                                            datetime.timezone(datetime.timedelta(hours=2)))
+    assert expected[3].microsecond == 123456
+    monkeypatch.setattr(serializer, 'sys', SimpleNamespace(version_info=(3, 10, 13)))
+    assert parse_date_times(ISOS) == expected
+
+
+def test_lazy_jsn_matches_eager():
+    doc = '{"a": NaN, "b": [Infinity, -Infinity], "c": {"d": 1.5}}'
+    lazy, eager = jsn(doc, lazy=True), jsn(doc)
+    assert math.isnan(lazy.a) and math.isnan(eager.a)
+    assert lazy.b.to_list() == eager.b == [math.inf, -math.inf]
+    assert lazy.c.d == eager.c.d == 1.5
+    with pytest.raises(ValueError):
+        jsn('{"a": ', lazy=True)
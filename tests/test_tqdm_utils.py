@@ -0,0 +1,157 @@
+import asyncio
+import os
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from hypy_utils import tqdm_utils
+from hypy_utils.tqdm_utils import WorkerPool, amap, imap, shared_array, worker_state
+
+
+def square(x: int) -> int:
+    return x * x
+
+
+def fail_on_7(x: int) -> int:
+    if x == 7:
+        raise ValueError(x)
+    return x
+
+
+@pytest.mark.parametrize('processes', [False, True])
+def test_imap_ordered_and_unordered(processes: bool):
+    expected = [square(i) for i in range(300)]
+    assert list(imap(square, range(300), processes=processes, max_workers=2, disable=True)) == expected
+    assert sorted(imap(square, range(300), ordered=False, processes=processes, max_workers=2,
+                       disable=True)) == expected
+
+
+def test_imap_generator_input():
+    # Unknown length, consumed lazily
+    assert list(imap(square, (i for i in range(1000)), processes=False, max_workers=4, disable=True)) == \
+        [square(i) for i in range(1000)]
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_imap_error_reaches_caller(ordered: bool):
+    with pytest.raises(ValueError):
+        list(imap(fail_on_7, range(100), ordered=ordered, processes=False, max_workers=2, disable=True))
+
+
+def test_imap_chunk_size_cap(monkeypatch):
+    sizes = []
+    apply_chunk = tqdm_utils._apply_chunk
+
+    def recording_apply_chunk(fn, chunk):
+        sizes.append(len(chunk))
+        return apply_chunk(fn, chunk)
+
+    monkeypatch.setattr(tqdm_utils, '_apply_chunk', recording_apply_chunk)
+    # Fast items grow the chunks, up to max_in_flight // max_workers
+    results = list(imap(square, range(5000), processes=False, max_workers=4, max_in_flight=40, disable=True))
+    assert results == [square(i) for i in range(5000)]
+    assert max(sizes) == 10
+
+
+def init_worker(log: str, offset: int) -> dict:
+    with open(log, 'a') as f:
+        f.write(f'{os.getpid()}\n')
+    return {'offset': offset}
+
+
+def lookup(i: int) -> int:
+    return worker_state()['offset'] + int(shared_array('table')[i])
+
+
+def test_worker_pool_state_and_shared_array(tmp_path: Path):
+    log = tmp_path / 'init.log'
+    table = np.arange(100, dtype=np.int64) * 3
+    with WorkerPool(max_workers=2, initializer=init_worker, initargs=(str(log), 1000), shared={'table': table}) as pool:
+        names = [shm.name for shm in pool._shm]
+        for _ in range(3):
+            assert pool.pmap(lookup, range(100), disable=True) == [1000 + 3 * i for i in range(100)]
+    # The initializer ran once per worker, not once per call
+    assert len(log.read_text().split()) <= 2
+
+    # Closing the pool unlinks the shared memory
+    for name in names:
+        with pytest.raises(FileNotFoundError):
+            SharedMemory(name)
+
+
+def test_amap_ordered_and_as_completed():
+    async def delayed(i: int) -> int:
+        # Later items finish first
+        await asyncio.sleep((10 - i) * 0.01)
+        return i
+
+    assert amap(delayed, range(10), disable=True) == list(range(10))
+    assert amap(delayed, range(10), ordered=False, disable=True) == list(reversed(range(10)))
+
+
+def test_amap_retry_backoff(monkeypatch):
+    attempts, retried, delays = {}, [], []
+    sleep = asyncio.sleep
+
+    async def fake_sleep(delay: float):
+        delays.append(delay)
+        await sleep(0)
+
+    async def flaky(i: int) -> int:
+        attempts[i] = attempts.get(i, 0) + 1
+        if attempts[i] <= 2:
+            raise ConnectionError(i)
+        return i
+
+    monkeypatch.setattr(asyncio, 'sleep', fake_sleep)
+    results = amap(flaky, range(3), retries=2, backoff=0.1, retry_on=(ConnectionError,),
+                   on_retry=lambda item, e, attempt: retried.append((item, attempt)), disable=True)
+    assert results == [0, 1, 2]
+    assert sorted(retried) == [(i, a) for i in range(3) for a in range(2)]
+    assert sorted(delays) == [0.1] * 3 + [0.2] * 3
+
+    # Giving up after the last retry raises the error
+    attempts.clear()
+    with pytest.raises(ConnectionError):
+        amap(flaky, range(3), retries=1, backoff=0.1, retry_on=(ConnectionError,), disable=True)
+
+
+def test_amap_input_error_reaches_caller():
+    async def identity(i: int) -> int:
+        return i
+
+    def items():
+        yield from range(5)
+        raise RuntimeError('broken input')
+
+    async def run():
+        return [r async for r in tqdm_utils.aimap(identity, items(), disable=True)]
+
+    with pytest.raises(RuntimeError, match='broken input'):
+        asyncio.run(asyncio.wait_for(run(), 5))
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_amap_concurrency_with_slow_head(ordered: bool):
+    running, peak, started = 0, 0, []
+    head_done = None
+
+    async def work(i: int) -> int:
+        nonlocal running, peak, head_done
+        running += 1
+        peak = max(peak, running)
+        started.append(i)
+        await asyncio.sleep(0.2 if i == 0 else 0)
+        running -= 1
+        if i == 0:
+            head_done = len(started)
+        return i
+
+    results = amap(work, range(100), concurrency=4, ordered=ordered, disable=True)
+    assert sorted(results) == list(range(100))
+    assert peak <= 4
+    if ordered:
+        # The results waiting for the head item hold their slots, so no more than concurrency items start
+        assert head_done <= 4
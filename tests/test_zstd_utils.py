@@ -0,0 +1,63 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from hypy_utils.zstd_utils import ZstArchive, load_many_json_zst, train_zstd_dict, write_many_json_zst
+
+ROOT = Path(__file__).parent.parent
+
+
+def test_archive_survives_interrupted_append(tmp_path: Path):
+    path = tmp_path / 'a.zar'
+    with ZstArchive(path, 'w') as ar:
+        for i in range(10):
+            ar[f'k{i}'] = {'i': i}
+
+    # Die in the middle of an append, after the new frames reached the file
+    code = f'''
+import os
+from hypy_utils.zstd_utils import ZstArchive
+ar = ZstArchive({str(path)!r}, 'a')
+ar['new'] = 1
+ar['k1'] = 'overwritten'
+ar._f.flush()
+os._exit(1)
+'''
+    subprocess.run([sys.executable, '-c', code], env={**os.environ, 'PYTHONPATH': str(ROOT)})
+
+    with ZstArchive(path) as ar:
+        assert len(ar) == 10 and 'new' not in ar and ar['k1'] == {'i': 1}
+    with ZstArchive(path, 'a') as ar:
+        ar['new'] = 1
+    with ZstArchive(path) as ar:
+        assert len(ar) == 11 and ar['new'] == 1 and ar['k9'] == {'i': 9}
+
+
+def test_archive_append_with_different_dict(tmp_path: Path):
+    samples = [f'{{"id": {i}, "name": "user {i}", "tags": ["a", "b"]}}'.encode() for i in range(500)]
+    zd = train_zstd_dict(samples, tmp_path / 'd.zdict', dict_size=2048)
+    path = tmp_path / 'a.zar'
+
+    with ZstArchive(path, 'w', fmt='json') as ar:
+        ar['plain'] = {'id': 0}
+    with ZstArchive(path, 'a', zdict=zd) as ar:
+        ar['dict'] = {'id': 1, 'name': 'user 1'}
+    with ZstArchive(path, 'a') as ar:
+        ar['plain2'] = [1, 2]
+
+    with ZstArchive(path) as ar:
+        assert ar['plain'] == {'id': 0}
+        assert ar['dict'] == {'id': 1, 'name': 'user 1'}
+        assert ar['plain2'] == [1, 2]
+
+
+@pytest.mark.parametrize('processes', [False, True])
+def test_many_json_zst_with_dict(tmp_path: Path, processes: bool):
+    docs = [{'id': i, 'name': f'user{i}', 'tags': ['a', str(i % 7)]} for i in range(200)]
+    zd = train_zstd_dict([repr(d).encode() * 3 for d in docs], dict_size=4096)
+    paths = [tmp_path / f'{i}.json.zst' for i in range(len(docs))]
+    assert write_many_json_zst(zip(paths, docs), workers=2, processes=processes, zdict=zd) == len(docs)
+    assert [d for _, d in load_many_json_zst(paths, workers=2, processes=processes)] == docs